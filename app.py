@@ -1,30 +1,57 @@
 import os
+import re
 import sys
+import gzip
+import heapq
+import json
+import mmap
+import math
+import zlib
+import time
 import yaml
 import uuid
+import base64
+import binascii
+import queue
+import atexit
+import collections
+import bisect
+import random
+import operator
+import shutil
+import struct
+import threading
+import socketserver
 import logging
+import logging.handlers
+import calendar
 import datetime
+import itertools
 import traceback
-from functools import wraps
+from functools import wraps, lru_cache
 from hashids import Hashids
 from passlib.hash import sha256_crypt
 from flask import Flask, request, flash, url_for, redirect, render_template, g
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask import has_request_context, has_app_context, make_response, jsonify
+from flask import Response, stream_with_context
+import sqlalchemy
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
 from flask.ext.restful import Resource, Api, abort
 from flask.ext.cors import CORS
 from flask.ext.login import LoginManager
 from flask.ext.login import login_user, logout_user, current_user, login_required
 
 try:
-    # Make dir to store logs in
-    os.makedirs('./logs/')
-except OSError:
-    pass
+    import msgpack
+except ImportError:
+    # Optional, only needed to return responses as MessagePack
+    msgpack = None
 
-logging.basicConfig(level=logging.DEBUG,
-                    filename='./logs/datalogging.log',
-                    format='%(asctime)s %(name)s %(levelname)s %(message)s'
-                    )
+try:
+    import redis
+except ImportError:
+    # Optional, only needed to share rate limits between workers
+    redis = None
 
 logger = logging.getLogger(__name__)
 
@@ -40,7 +67,55 @@ config = {'db_uri': 'sqlite:///datalogger.sqlite',
           'host': '0.0.0.0',
           'port': 5000,
           'secret_key': 'SECRET_KEY',
-          'schema': 'datalogging'
+          'schema': 'datalogging',
+          'log_file': './logs/datalogging.log',
+          'log_level': 'INFO',
+          # Fraction of records below WARNING to keep per endpoint, 1.0 keeps all
+          'log_sample_rates': {},
+          # Line protocol ingest listener, disabled if the port is not set
+          'line_protocol_port': None,
+          'line_protocol_precision': 'ns',
+          'line_protocol_batch_size': 5000,
+          'line_protocol_flush_interval': 1.0,
+          'line_protocol_cache_ttl': 60,
+          # Most api keys and sensor keys, valid or not, to keep in each lookup cache
+          'line_protocol_cache_size': 10000,
+          # Responses smaller then this (in bytes) are not compressed
+          'compress_min_size': 500,
+          'compress_level': 6,
+          # Compress old readings into per sensor chunks of chunk_interval seconds
+          'chunk_storage': False,
+          'chunk_interval': 7200,
+          'chunk_compact_interval': 600,
+          # Token bucket limits as {'rate': <tokens per second>, 'burst': <bucket size>}
+          'rate_limit_apikey': None,
+          'rate_limit_sensor': None,
+          # Share the rate limit buckets between workers, e.g. redis://localhost:6379/0
+          'rate_limit_redis_url': None,
+          # Api keys that can read the process wide /metrics endpoints
+          'metrics_apikeys': [],
+          # Number of recent idempotency keys and client timestamped readings to remember
+          'idempotency_cache_size': 100000,
+          # Keep count/sum/min/max/percentiles per sensor per stats_bucket_interval seconds
+          'sensor_stats': False,
+          'stats_bucket_interval': 3600,
+          'stats_flush_interval': 10,
+          # Read only replicas of db_uri used by the read only api and ui listings
+          'db_read_uris': [],
+          # Seconds a replica can be behind before reads go back to the primary
+          'replica_max_lag': 30,
+          'replica_check_interval': 5,
+          # Rows removed per statement when purging a deleted sensor
+          'delete_chunk_size': 5000,
+          # Most rows the web ui tables can request at once
+          'datatable_max_length': 100,
+          # Most rows an interval aligned /get/group request can return
+          'align_max_rows': 100000,
+          # Move readings older then archive_age seconds into segment files under archive_dir
+          'archive_dir': None,
+          'archive_age': 7776000,
+          'archive_interval': 3600,
+          'archive_batch_size': 5000,
           }
 
 if len(sys.argv) >= 2:
@@ -50,12 +125,202 @@ if len(sys.argv) >= 2:
     with open(sys.argv[1], 'r') as stream:
         config.update(yaml.load(stream))
 
+
+#######################
+# Logging
+#######################
+class JsonFormatter(logging.Formatter):
+    """
+    Render each log record as a single line of JSON
+    """
+    def format(self, record):
+        entry = {'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + "+0000",
+                 'name': record.name,
+                 'level': record.levelname,
+                 'message': record.getMessage(),
+                 }
+        if getattr(record, 'endpoint', None) is not None:
+            entry['endpoint'] = record.endpoint
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry)
+
+
+class EndpointSampleFilter(logging.Filter):
+    """
+    Tag records with the flask endpoint and only keep a sample of the
+    low level records for the endpoints listed in `sample_rates`
+    """
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        record.endpoint = request.endpoint if has_request_context() else None
+        if record.levelno >= logging.WARNING:
+            # Never drop warnings or errors
+            return True
+        rate = self.sample_rates.get(record.endpoint, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand the record to the queue as is, the message is formatted by the
+    listener thread so the request thread does not pay for it
+    """
+    def prepare(self, record):
+        return record
+
+
+def setup_logging():
+    log_dir = os.path.dirname(config['log_file'])
+    try:
+        # Make dir to store logs in
+        os.makedirs(log_dir)
+    except OSError:
+        pass
+
+    file_handler = logging.FileHandler(config['log_file'])
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(-1)
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(EndpointSampleFilter(config['log_sample_rates']))
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(config['log_level'].upper())
+    root_logger.addHandler(queue_handler)
+
+    # Background thread that does the actual file writes
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
+
+#######################
+# Read Replicas
+#######################
+def replica_lag(connection):
+    """
+    :returns: seconds the replica is behind the primary, None if replication is broken
+    """
+    dialect = connection.dialect.name
+    if dialect == 'mysql':
+        status = connection.execute("SHOW SLAVE STATUS").first()
+        if status is None:
+            # Not replicating from anything
+            return 0
+        return status['Seconds_Behind_Master']
+    if dialect == 'postgresql':
+        # The last replay time stops moving while the primary is idle, so only
+        # use it when the replica has not replayed everything it received
+        lag = connection.execute("SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                                 "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")\
+                        .scalar()
+        return lag or 0
+    connection.execute("SELECT 1")
+    return 0
+
+
+class ReplicaPool:
+    """
+    Round robin over the read replicas that passed the last health check
+    """
+    def __init__(self, uris, max_lag):
+        self.engines = [sqlalchemy.create_engine(uri, pool_recycle=3600) for uri in uris]
+        self.max_lag = max_lag
+        self.healthy = list(self.engines)
+        self._next = itertools.count()
+
+    def check(self):
+        healthy = []
+        for engine in self.engines:
+            try:
+                with engine.connect() as connection:
+                    lag = replica_lag(connection)
+            except Exception:
+                logger.warning("[ReplicaPool] Replica %s is down", engine.url, exc_info=True)
+                continue
+            if lag is None or lag > self.max_lag:
+                logger.warning("[ReplicaPool] Replica %s is lagging (%s seconds)", engine.url, lag)
+                continue
+            healthy.append(engine)
+        self.healthy = healthy
+
+    def get(self):
+        """
+        :returns: a healthy replica engine, None if there are none
+        """
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self._next) % len(healthy)]
+
+    def mark_down(self, engine):
+        # Skipped until the next check finds it healthy again
+        self.healthy = [healthy for healthy in self.healthy if healthy is not engine]
+
+    def run(self, interval):
+        while True:
+            self.check()
+            time.sleep(interval)
+
+
+replica_pool = ReplicaPool(config['db_read_uris'], float(config['replica_max_lag']))
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends queries to the request's read replica, `g.read_replica`, while it is set
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_app_context():
+            engine = getattr(g, 'read_replica', None)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+
+def use_read_replica(func):
+    """
+    Only use on views that never write to the database
+    One replica is used for the whole request so all of its reads see the same data
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        engine = replica_pool.get()
+        if engine is not None:
+            try:
+                # Check out the connection the rest of the request reads with, so a
+                # replica that went down since the last check falls back to the primary
+                db.session.connection(bind=engine).execute("SELECT 1")
+                g.read_replica = engine
+            except sqlalchemy.exc.DBAPIError:
+                logger.warning("[use_read_replica] Replica %s failed, using the primary",
+                               engine.url, exc_info=True)
+                db.session.rollback()
+                replica_pool.mark_down(engine)
+        return func(*args, **kwargs)
+    return wrapper
+
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = config['secret_key']
 app.config['SQLALCHEMY_DATABASE_URI'] = config['db_uri']
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 api = Api(app, prefix='/api/v1')
 cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 
@@ -72,9 +337,14 @@ def generate_api_key():
     return str(uuid.uuid4())
 
 
+@lru_cache(maxsize=None)
+def get_hashids(salt, size):
+    # Building the alphabet for a salt is slow, so reuse the encoders
+    return Hashids(salt=salt, min_length=size)
+
+
 def generate_key(id, salt, size=6):
-    hashids = Hashids(salt=salt, min_length=size)
-    return hashids.encode(id)
+    return get_hashids(salt, size).encode(id)
 
 
 #######################
@@ -134,11 +404,11 @@ class ApiKey(db.Model):
     __table_args__ = {'schema': config['schema']}
     __tablename__ = 'apikeys'
     id = db.Column('id', db.Integer, primary_key=True)
-    name = db.Column(db.String(60))
+    name = db.Column(db.String(60), index=True)
     host = db.Column(db.String(255))
     key = db.Column(db.String(36), default=generate_api_key, unique=True)
     date_added = db.Column(db.DateTime, default=datetime.datetime.now)
-    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'), index=True)
 
     def __init__(self, name, host):
         self.name = name
@@ -149,14 +419,20 @@ class Sensor(db.Model):
     __table_args__ = {'schema': config['schema']}
     __tablename__ = 'sensors'
     id = db.Column('id', db.Integer, primary_key=True)
-    name = db.Column(db.String(60))
+    name = db.Column(db.String(60), index=True)
     data_type = db.Column(db.String(16))
     key = db.Column(db.String(36), unique=True)
     date_added = db.Column(db.DateTime, default=datetime.datetime.now)
-    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'))
-    group_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.groups.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'), index=True)
+    group_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.groups.id'), index=True)
     sensor_data = db.relationship('SensorData', backref='sensor',
                                   cascade='all, delete', lazy='dynamic')
+    sensor_data_chunks = db.relationship('SensorDataChunk', backref='sensor',
+                                         cascade='all, delete', lazy='dynamic')
+    sensor_stats_buckets = db.relationship('SensorStatsBucket', backref='sensor',
+                                           cascade='all, delete', lazy='dynamic')
+    archive_segments = db.relationship('ArchiveSegment', backref='sensor',
+                                       cascade='all, delete', lazy='dynamic')
 
     def __init__(self, name, data_type):
         self.name = name
@@ -167,10 +443,11 @@ class SensorTemplate(db.Model):
     __table_args__ = {'schema': config['schema']}
     __tablename__ = 'sensor_templates'
     id = db.Column('id', db.Integer, primary_key=True)
-    name = db.Column(db.String(60))
+    name = db.Column(db.String(60), index=True)
     data_type = db.Column(db.String(16))
-    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'))
-    group_template_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.group_templates.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'), index=True)
+    group_template_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.group_templates.id'),
+                                  index=True)
 
     def __init__(self, name, data_type):
         self.name = name
@@ -178,7 +455,8 @@ class SensorTemplate(db.Model):
 
 
 class SensorData(db.Model):
-    __table_args__ = {'schema': config['schema']}
+    __table_args__ = (db.Index('ix_sensor_data_sensor_id_date_added', 'sensor_id', 'date_added'),
+                      {'schema': config['schema']})
     __tablename__ = 'sensor_data'
     id = db.Column('id', db.Integer, primary_key=True)
     # value = db.Column(db.String(128))
@@ -188,17 +466,182 @@ class SensorData(db.Model):
     date_added = db.Column(db.DateTime, default=datetime.datetime.now)
     sensor_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.sensors.id'))
 
-    def __init__(self, value):
+    def __init__(self, value, date_added=None):
         self.value = str(value)
+        if date_added is not None:
+            self.date_added = date_added
 
 
-class Group(db.Model):
+class SensorDataChunk(db.Model):
+    __table_args__ = (db.UniqueConstraint('sensor_id', 'start'),
+                      {'schema': config['schema']})
+    __tablename__ = 'sensor_data_chunks'
+    id = db.Column('id', db.Integer, primary_key=True)
+    # Start of the chunk_interval window the points fall in
+    start = db.Column(db.DateTime)
+    # Timestamp of the newest point in the chunk
+    end = db.Column(db.DateTime)
+    count = db.Column(db.Integer)
+    encoding = db.Column(db.String(16))
+    data = db.Column(db.LargeBinary(2**24 - 1))
+    sensor_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.sensors.id'), index=True)
+
+    def __init__(self, start, encoding):
+        self.start = start
+        self.encoding = encoding
+
+
+class ArchiveSegment(db.Model):
+    __table_args__ = (db.UniqueConstraint('sensor_id', 'seq'),
+                      {'schema': config['schema']})
+    __tablename__ = 'archive_segments'
+    id = db.Column('id', db.Integer, primary_key=True)
+    # Segments are numbered per sensor, the files are <archive_dir>/<sensor_id>/<seq>.seg/.idx
+    seq = db.Column(db.Integer)
+    # Timestamps of the oldest and newest records
+    start = db.Column(db.DateTime)
+    end = db.Column(db.DateTime)
+    # Records and bytes of the .seg file that have been committed
+    count = db.Column(db.Integer)
+    size = db.Column(db.BigInteger)
+    sensor_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.sensors.id'))
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.count = 0
+        self.size = 0
+
+
+class SensorStatsBucket(db.Model):
+    __table_args__ = (db.UniqueConstraint('sensor_id', 'start'),
+                      {'schema': config['schema']})
+    __tablename__ = 'sensor_stats_buckets'
+    id = db.Column('id', db.Integer, primary_key=True)
+    # Start of the stats_bucket_interval window the readings fall in
+    start = db.Column(db.DateTime)
+    count = db.Column(db.Integer)
+    sum = db.Column(db.Float)
+    min = db.Column(db.Float)
+    max = db.Column(db.Float)
+    last_time = db.Column(db.DateTime)
+    last_value = db.Column(db.Float)
+    digest = db.Column(db.LargeBinary)
+    sensor_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.sensors.id'), index=True)
+
+    def __init__(self, start):
+        self.start = start
+
+    def summary(self):
+        summary = StatsSummary()
+        summary.count = self.count
+        summary.sum = self.sum
+        summary.min = self.min
+        summary.max = self.max
+        summary.last_time = self.last_time
+        summary.last_value = self.last_value
+        summary.digest = TDigest.from_bytes(self.digest)
+        return summary
+
+    def update(self, summary):
+        self.count = summary.count
+        self.sum = summary.sum
+        self.min = summary.min
+        self.max = summary.max
+        self.last_time = summary.last_time
+        self.last_value = summary.last_value
+        self.digest = summary.digest.to_bytes()
+
+
+class SensorStatsSince(db.Model):
+    __table_args__ = {'schema': config['schema']}
+    __tablename__ = 'sensor_stats_since'
+    id = db.Column('id', db.Integer, primary_key=True)
+    # Buckets starting at or after this have every reading, older ones may be missing some
+    since = db.Column(db.DateTime)
+    sensor_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.sensors.id'), unique=True)
+
+    def __init__(self, since):
+        self.since = since
+
+
+class DeletionJob(db.Model):
+    __table_args__ = {'schema': config['schema']}
+    __tablename__ = 'deletion_jobs'
+    id = db.Column('id', db.Integer, primary_key=True)
+    # sensor or group
+    kind = db.Column(db.String(16))
+    target_id = db.Column(db.Integer)
+    name = db.Column(db.String(60))
+    total = db.Column(db.Integer)
+    deleted = db.Column(db.Integer, default=0)
+    date_added = db.Column(db.DateTime, default=datetime.datetime.now)
+    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'), index=True)
+
+    def __init__(self, kind, target_id, name):
+        self.kind = kind
+        self.target_id = target_id
+        self.name = name
+
+    def progress(self):
+        if not self.total:
+            return 0
+        return int(100 * (self.deleted or 0) / self.total)
+
+
+class SensorRule(db.Model):
     __table_args__ = {'schema': config['schema']}
+    __tablename__ = 'sensor_rules'
+    id = db.Column('id', db.Integer, primary_key=True)
+    # threshold or derived
+    kind = db.Column(db.String(16))
+    # Threshold rules, alert when `value <operator> threshold` for `duration` seconds
+    operator = db.Column(db.String(2))
+    threshold = db.Column(db.Float)
+    duration = db.Column(db.Integer, default=0)
+    # Derived rules, write `function` of the readings to the target sensor
+    function = db.Column(db.String(16))
+    target_sensor_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.sensors.id'))
+    date_added = db.Column(db.DateTime, default=datetime.datetime.now)
+    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'), index=True)
+    # Rules are attached to either a sensor or every sensor in a group
+    sensor_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.sensors.id'), index=True)
+    group_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.groups.id'), index=True)
+
+    def __init__(self, kind):
+        self.kind = kind
+
+    def to_dict(self):
+        return {'id': self.id,
+                'kind': self.kind,
+                'operator': self.operator,
+                'threshold': self.threshold,
+                'duration': self.duration,
+                'function': self.function,
+                }
+
+
+class SensorEvent(db.Model):
+    __table_args__ = (db.Index('ix_sensor_events_sensor_id_date_added', 'sensor_id', 'date_added'),
+                      {'schema': config['schema']})
+    __tablename__ = 'sensor_events'
+    id = db.Column('id', db.Integer, primary_key=True)
+    # Not a foreign key so rules can be deleted without touching their events
+    rule_id = db.Column(db.Integer)
+    # alert or clear
+    kind = db.Column(db.String(16))
+    value = db.Column(db.Float)
+    date_added = db.Column(db.DateTime)
+    sensor_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.sensors.id'))
+
+
+class Group(db.Model):
+    __table_args__ = (db.Index('ix_groups_user_id_name', 'user_id', 'name'),
+                      {'schema': config['schema']})
     __tablename__ = 'groups'
     id = db.Column('id', db.Integer, primary_key=True)
-    name = db.Column(db.String(32))
+    name = db.Column(db.String(32), index=True)
     key = db.Column(db.String(36), unique=True)
-    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'), index=True)
     sensor = db.relationship('Sensor', backref='group', lazy='dynamic')
 
     def __init__(self, name):
@@ -209,8 +652,8 @@ class GroupTemplate(db.Model):
     __table_args__ = {'schema': config['schema']}
     __tablename__ = 'group_templates'
     id = db.Column('id', db.Integer, primary_key=True)
-    name = db.Column(db.String(32))
-    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'))
+    name = db.Column(db.String(32), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey(config['schema']+'.users.id'), index=True)
     sensor = db.relationship('SensorTemplate', backref='group',
                              cascade='all, delete', lazy='dynamic')
 
@@ -223,13 +666,13 @@ class GroupTemplate(db.Model):
 #######################
 @app.route('/')
 def index():
-    logger.info("Index page with type {}".format(request.method))
+    logger.debug("Index page with type %s", request.method)
     return render_template('index.html')
 
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
-    logger.info("Register page with type {}".format(request.method))
+    logger.debug("Register page with type %s", request.method)
     if config['disable_registration'] is True:
         flash("Registration is disabled at this time")
         return redirect(url_for('login'))
@@ -257,7 +700,7 @@ def register():
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-    logger.info("Login page with type {}".format(request.method))
+    logger.debug("Login page with type %s", request.method)
     if request.method == 'GET':
         return render_template('login.html')
 
@@ -269,26 +712,24 @@ def login():
     registered_user = User.query.filter_by(email=email).first()
 
     if registered_user is None:
-        logger.warning("Invalid email/password: Email: \"{}\" Pass: \"{}\""
-                       .format(email, password))
+        logger.warning("Invalid email/password: Email: \"%s\"", email)
         flash("Invalid email/password", 'error')
         return redirect(url_for('login'))
 
     if not registered_user.verify_password(password):
-        logger.warning("Invalid email/password: Email: \"{}\" Pass: \"{}\""
-                       .format(email, password))
+        logger.warning("Invalid email/password: Email: \"%s\"", email)
         flash("Invalid email/password", 'error')
         return redirect(url_for('login'))
 
     login_user(registered_user, remember=remember_me)
-    logger.info("User {} logged in".format(email))
+    logger.info("User %s logged in", email)
     flash("Logged in successfully")
     return redirect(request.args.get('next') or url_for('index'))
 
 
 @app.route('/logout')
 def logout():
-    logger.info("User {} logged out".format(g.user.email))
+    logger.info("User %s logged out", g.user.email)
     logout_user()
     return redirect(url_for('index'))
 
@@ -299,7 +740,7 @@ def logout():
 @app.route('/apikeys', methods=['GET', 'POST'])
 @login_required
 def apikeys():
-    logger.info("Api Keys page with type {}".format(request.method))
+    logger.debug("Api Keys page with type %s", request.method)
     if request.method == 'POST':
         if not request.form['name']:
             flash("Name is required", 'error')
@@ -311,9 +752,26 @@ def apikeys():
             flash("Api key was successfully created")
             return redirect(url_for('apikeys'))
 
-    return render_template('apikeys.html',
-                           apikeys=ApiKey.query.filter_by(user_id=g.user.id).all()
-                           )
+    return render_template('apikeys.html')
+
+
+@app.route('/apikeys/data', methods=['GET'])
+@login_required
+@use_read_replica
+def apikeys_data():
+    query = db.session.query(ApiKey.id, ApiKey.name, ApiKey.key, ApiKey.date_added)\
+                      .filter(ApiKey.user_id == g.user.id)
+    columns = {'name': ApiKey.name,
+               'key': ApiKey.key,
+               'date_added': ApiKey.date_added,
+               }
+    return datatable_response(query, columns, ['name', 'key'],
+                              lambda row: {'id': row.id,
+                                           'name': row.name,
+                                           'key': row.key,
+                                           'date_added': row.date_added.strftime('%Y-%m-%d %H:%M'),
+                                           },
+                              ApiKey.id)
 
 
 @app.route('/apikey/delete/<int:apikey_id>', methods=['GET'])
@@ -323,7 +781,7 @@ def apikey_delete(apikey_id):
                           .filter_by(id=apikey_id).scalar()
     db.session.delete(api_key)
     db.session.commit()
-    logger.info("User {} deleted API Key {}".format(g.user, api_key.name))
+    logger.info("User %s deleted API Key %s", g.user.email, api_key.name)
     flash("Deleted API key " + api_key.name)
     return redirect(url_for('apikeys'))
 
@@ -354,27 +812,61 @@ def sensors():
             db.session.flush()
             sensor.key = generate_key(sensor.id, 'Sensor salt xyz')
             db.session.commit()
-            logger.info("User {} created sensor {} - {}"
-                        .format(g.user.email, sensor.key, sensor.name))
+            logger.info("User %s created sensor %s - %s",
+                        g.user.email, sensor.key, sensor.name)
             flash("Sensor {} was successfully created".format(sensor.name))
             return redirect(url_for('sensors'))
 
     return render_template('sensors.html',
-                           sensors=Sensor.query.filter_by(user_id=g.user.id).all(),
                            groups=Group.query.filter_by(user_id=g.user.id)
-                                             .order_by(Group.name.asc()).all()
+                                             .order_by(Group.name.asc()).all(),
+                           deletions=DeletionJob.query.filter_by(user_id=g.user.id, kind='sensor').all()
                            )
 
 
+@app.route('/sensors/data', methods=['GET'])
+@login_required
+@use_read_replica
+def sensors_data():
+    query = db.session.query(Sensor.id, Sensor.name, Sensor.key, Sensor.data_type,
+                             Sensor.date_added, Group.name.label('group_name'))\
+                      .outerjoin(Group, Sensor.group_id == Group.id)\
+                      .filter(Sensor.user_id == g.user.id)
+    columns = {'group': Group.name,
+               'name': Sensor.name,
+               'key': Sensor.key,
+               'data_type': Sensor.data_type,
+               'date_added': Sensor.date_added,
+               }
+    return datatable_response(query, columns, ['group', 'name', 'key'],
+                              lambda row: {'id': row.id,
+                                           'group': row.group_name,
+                                           'name': row.name,
+                                           'key': row.key,
+                                           'data_type': row.data_type,
+                                           'date_added': row.date_added.strftime('%Y-%m-%d %H:%M'),
+                                           },
+                              Sensor.id)
+
+
 @app.route('/sensor/delete/<int:sensor_id>', methods=['GET'])
 @login_required
 def sensor_delete(sensor_id):
     sensor = Sensor.query.filter_by(user_id=g.user.id).filter_by(id=sensor_id).scalar()
-    db.session.delete(sensor)
+    sensor_key = sensor.key
+    job = DeletionJob('sensor', sensor.id, sensor.name)
+    job.user_id = g.user.id
+    # Detach the sensor so it is gone from the api and ui right away,
+    # its data is purged in the background
+    sensor.user_id = None
+    sensor.group_id = None
+    sensor.key = None
+    db.session.add(job)
     db.session.commit()
-    logger.info("User {} deleted sensor {} - {}"
-                .format(g.user.email, sensor.key, sensor.name))
-    flash("Deleted sensor " + sensor.name)
+    deletion_jobs_ready.set()
+    logger.info("User %s deleted sensor %s - %s",
+                g.user.email, sensor_key, sensor.name)
+    flash("Deleting sensor " + sensor.name)
     return redirect(url_for('sensors'))
 
 
@@ -389,53 +881,72 @@ def groups():
         template_id = request.form['group-template'].strip()
         if not name:
             flash("Name is required", 'error')
+        elif len(name) > Group.name.type.length:
+            flash("Name can be at most {} characters".format(Group.name.type.length), 'error')
         else:
             # Check if group name for user already exists
             is_group = Group.query.filter_by(user_id=g.user.id).filter_by(name=name).scalar()
             if is_group is not None:
                 flash("Group with name {} already exists".format(name), 'error')
             else:
-                group = Group(name)
-                group.user = g.user
-                db.session.add(group)
-                # Flush to get the id so it can be encoded
-                db.session.flush()
-                group.key = generate_key(group.id, 'Group salt abc')
-                # If a template was selected, get and create all the sensors for this group
                 if template_id:
-                    template_sensors = SensorTemplate.query.filter_by(user_id=g.user.id)\
-                                                           .filter_by(group_template_id=template_id)
-                    for sensor in template_sensors:
-                        sensor = Sensor(sensor.name, sensor.data_type)
-                        sensor.user = g.user
-                        sensor.group = group
-                        db.session.add(sensor)
-                        # Flush to get the id so it can be encoded
-                        db.session.flush()
-                        sensor.key = generate_key(sensor.id, 'Sensor salt xyz')
-
-                db.session.commit()
-                logger.info("User {} created group {} - {}"
-                            .format(g.user.email, group.key, group.name))
+                    # Create the group with all of the sensors from the template
+                    group = create_groups_from_template(g.user.id, int(template_id), [name])[0]
+                else:
+                    group = Group(name)
+                    group.user = g.user
+                    db.session.add(group)
+                    # Flush to get the id so it can be encoded
+                    db.session.flush()
+                    group.key = generate_key(group.id, 'Group salt abc')
+                    db.session.commit()
+
+                logger.info("User %s created group %s - %s",
+                            g.user.email, group.key, group.name)
                 flash("Group {} was successfully created".format(group.name))
                 return redirect(url_for('groups'))
 
     return render_template('groups.html',
-                           groups=Group.query.filter_by(user_id=g.user.id).all(),
+                           deletions=DeletionJob.query.filter_by(user_id=g.user.id, kind='group').all(),
                            group_templates=GroupTemplate.query.filter_by(user_id=g.user.id)
                                                         .order_by(GroupTemplate.name.asc()).all()
                            )
 
 
+@app.route('/groups/data', methods=['GET'])
+@login_required
+@use_read_replica
+def groups_data():
+    query = db.session.query(Group.id, Group.name, Group.key)\
+                      .filter(Group.user_id == g.user.id)
+    columns = {'name': Group.name,
+               'key': Group.key,
+               }
+    return datatable_response(query, columns, ['name', 'key'],
+                              lambda row: {'id': row.id,
+                                           'name': row.name,
+                                           'key': row.key,
+                                           },
+                              Group.id)
+
+
 @app.route('/group/delete/<int:group_id>', methods=['GET'])
 @login_required
 def group_delete(group_id):
     group = Group.query.filter_by(user_id=g.user.id).filter_by(id=group_id).scalar()
-    db.session.delete(group)
+    group_key = group.key
+    job = DeletionJob('group', group.id, group.name)
+    job.user_id = g.user.id
+    # Detach the group so it is gone from the api and ui right away,
+    # its sensors are removed from it in the background
+    group.user_id = None
+    group.key = None
+    db.session.add(job)
     db.session.commit()
-    logger.info("User {} deleted group {} - {}"
-                .format(g.user.email, group.key, group.name))
-    flash("Deleted group {}".format(group.name))
+    deletion_jobs_ready.set()
+    logger.info("User %s deleted group %s - %s",
+                g.user.email, group_key, group.name)
+    flash("Deleting group {}".format(group.name))
     return redirect(url_for('groups'))
 
 
@@ -446,12 +957,46 @@ def group_delete(group_id):
 @login_required
 def template():
     return render_template('group_templates.html',
-                           sensors=SensorTemplate.query.filter_by(user_id=g.user.id).all(),
                            groups=GroupTemplate.query.filter_by(user_id=g.user.id)
                                                      .order_by(GroupTemplate.name.asc()).all()
                            )
 
 
+@app.route('/templates/groups/data', methods=['GET'])
+@login_required
+@use_read_replica
+def group_templates_data():
+    query = db.session.query(GroupTemplate.id, GroupTemplate.name)\
+                      .filter(GroupTemplate.user_id == g.user.id)
+    columns = {'name': GroupTemplate.name}
+    return datatable_response(query, columns, ['name'],
+                              lambda row: {'id': row.id,
+                                           'name': row.name,
+                                           },
+                              GroupTemplate.id)
+
+
+@app.route('/templates/sensors/data', methods=['GET'])
+@login_required
+@use_read_replica
+def sensor_templates_data():
+    query = db.session.query(SensorTemplate.id, SensorTemplate.name, SensorTemplate.data_type,
+                             GroupTemplate.name.label('group_name'))\
+                      .outerjoin(GroupTemplate, SensorTemplate.group_template_id == GroupTemplate.id)\
+                      .filter(SensorTemplate.user_id == g.user.id)
+    columns = {'group': GroupTemplate.name,
+               'name': SensorTemplate.name,
+               'data_type': SensorTemplate.data_type,
+               }
+    return datatable_response(query, columns, ['group', 'name'],
+                              lambda row: {'id': row.id,
+                                           'group': row.group_name,
+                                           'name': row.name,
+                                           'data_type': row.data_type,
+                                           },
+                              SensorTemplate.id)
+
+
 @app.route('/template/add/sensor', methods=['POST'])
 @login_required
 def add_sensor_template():
@@ -475,8 +1020,8 @@ def add_sensor_template():
 
             db.session.add(sensor)
             db.session.commit()
-            logger.info("User {} created sensor {} - {} for template group {}"
-                        .format(g.user.email, sensor.id, sensor.name, sensor.group.name))
+            logger.info("User %s created sensor %s - %s for template group %s",
+                        g.user.email, sensor.id, sensor.name, sensor.group.name)
             flash("Sensor {} was successfully created".format(sensor.name))
     return redirect(url_for('template'))
 
@@ -488,8 +1033,8 @@ def sensor_template_delete(sensor_id):
                                  .filter_by(id=sensor_id).scalar()
     db.session.delete(sensor)
     db.session.commit()
-    logger.info("User {} deleted sensor {} - {} from template"
-                .format(g.user.email, sensor.id, sensor.name))
+    logger.info("User %s deleted sensor %s - %s from template",
+                g.user.email, sensor.id, sensor.name)
     flash("Deleted sensor " + sensor.name)
     return redirect(url_for('template'))
 
@@ -502,7 +1047,6 @@ def add_group_template():
         if not name:
             flash("Name is required", 'error')
         else:
-            print(g.user.id)
             # Check if group name for user already exists
             is_group = GroupTemplate.query.filter_by(user_id=g.user.id)\
                                           .filter_by(name=name).scalar()
@@ -513,8 +1057,8 @@ def add_group_template():
                 group.user = g.user
                 db.session.add(group)
                 db.session.commit()
-                logger.info("User {} created template group {} - {}"
-                            .format(g.user.email, group.id, group.name))
+                logger.info("User %s created template group %s - %s",
+                            g.user.email, group.id, group.name)
                 flash("Group {} was successfully created".format(group.name))
     return redirect(url_for('template'))
 
@@ -526,12 +1070,214 @@ def group_template_delete(group_id):
                                .filter_by(id=group_id).scalar()
     db.session.delete(group)
     db.session.commit()
-    logger.info("User {} deleted template group {} - {}"
-                .format(g.user.email, group.id, group.name))
+    logger.info("User %s deleted template group %s - %s",
+                g.user.email, group.id, group.name)
     flash("Deleted group template {}".format(group.name))
     return redirect(url_for('template'))
 
 
+#######################
+# Rate Limiting
+#######################
+class TokenBucketLimiter:
+    """
+    In process token buckets, striped by key so requests for different keys
+    rarely wait on each other. Buckets that have refilled are dropped once a
+    stripe holds more then `prune_size`, as a full bucket is the same as none
+    """
+    def __init__(self, stripes=64, prune_size=1000):
+        # [{key: (level, updated, full_at)}, lock, size to prune at]
+        self.stripes = [[{}, threading.Lock(), prune_size] for _ in range(stripes)]
+        self.prune_size = prune_size
+
+    def acquire(self, key, rate, burst, tokens=1):
+        """
+        :returns: 0 if the tokens were taken, otherwise seconds until there are enough tokens
+        """
+        now = time.monotonic()
+        stripe = self.stripes[hash(key) % len(self.stripes)]
+        buckets = stripe[0]
+        with stripe[1]:
+            level, updated, _ = buckets.get(key, (burst, now, now))
+            level = min(burst, level + (now - updated) * rate)
+            retry_after = 0
+            if level >= tokens:
+                level -= tokens
+            else:
+                retry_after = (tokens - level) / rate
+            buckets[key] = (level, now, now + (burst - level) / rate)
+
+            if len(buckets) > stripe[2]:
+                for full_key in [full_key for full_key, bucket in buckets.items() if bucket[2] <= now]:
+                    del buckets[full_key]
+                # Do not scan again on every request while the buckets are all in use
+                stripe[2] = max(self.prune_size, len(buckets) * 2)
+        return retry_after
+
+
+class RedisTokenBucketLimiter:
+    """
+    Token buckets stored in redis so every worker shares the same limits
+    """
+    script = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local tokens = tonumber(ARGV[4])
+        local bucket = redis.call('HMGET', KEYS[1], 'level', 'updated')
+        local level = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        level = math.min(burst, level + math.max(0, now - updated) * rate)
+        local retry_after = 0
+        if level >= tokens then
+            level = level - tokens
+        else
+            retry_after = (tokens - level) / rate
+        end
+        redis.call('HMSET', KEYS[1], 'level', level, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(retry_after)
+    """
+
+    def __init__(self, url):
+        self.client = redis.StrictRedis.from_url(url)
+        self.take = self.client.register_script(self.script)
+
+    def acquire(self, key, rate, burst, tokens=1):
+        try:
+            return float(self.take(keys=['ratelimit:' + key], args=[rate, burst, time.time(), tokens]))
+        except redis.RedisError:
+            # Do not block ingest because redis is down
+            logger.warning("[RedisTokenBucketLimiter] Failed to check rate limit", exc_info=True)
+            return 0
+
+
+if config['rate_limit_redis_url'] and redis is not None:
+    rate_limiter = RedisTokenBucketLimiter(config['rate_limit_redis_url'])
+else:
+    rate_limiter = TokenBucketLimiter()
+
+# Number of allowed and limited requests per limit since the app started
+rate_limit_metrics = {'apikey': {'allowed': 0, 'limited': 0},
+                      'sensor': {'allowed': 0, 'limited': 0},
+                      }
+
+
+def rate_limit_wait(name, key):
+    """
+    Take a token from the `name` limit for `key`
+    :returns: 0 if allowed, otherwise seconds until the request would be allowed
+    """
+    limit = config['rate_limit_' + name]
+    if not limit:
+        return 0
+
+    retry_after = rate_limiter.acquire(name + ':' + key, float(limit['rate']), float(limit['burst']))
+    if retry_after:
+        rate_limit_metrics[name]['limited'] += 1
+    else:
+        rate_limit_metrics[name]['allowed'] += 1
+    return retry_after
+
+
+def rate_limited_response(name, retry_after):
+    logger.debug("Rate limited %s, retry after %s", name, retry_after)
+    rdata = {'success': False,
+             'message': "Rate limit exceeded for {}".format(name)
+             }
+    return rdata, 429, {'Retry-After': str(int(math.ceil(retry_after)))}
+
+
+#######################
+# Deduplication
+#######################
+class RecentlySeen:
+    """
+    Bounded map of recently seen keys, the oldest keys are dropped first
+    """
+    def __init__(self, size):
+        self.size = size
+        self.keys = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.keys.get(key)
+
+    def add(self, key, value=True):
+        with self.lock:
+            self.keys[key] = value
+            self.keys.move_to_end(key)
+            if len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+
+
+# (apikey, idempotency key) -> response that was sent for it
+idempotency_keys = RecentlySeen(int(config['idempotency_cache_size']))
+# (sensor id, timestamp) of readings added with a client timestamp
+seen_readings = RecentlySeen(int(config['idempotency_cache_size']))
+
+
+# (chunk id, count) -> epoch us of the chunks readings
+compacted_chunk_times = RecentlySeen(16)
+
+
+def stored_timestamp(timestamp):
+    """
+    Truncate a client timestamp to the precision the database stores, so a
+    resent reading compares equal to the stored one. MySQL DATETIME columns
+    only keep whole seconds
+    """
+    if db.engine.dialect.name == 'mysql':
+        return timestamp.replace(microsecond=0)
+    return timestamp
+
+
+def in_compacted_storage(sensor_id, date_added):
+    """
+    Check the chunks and the archive for a reading. Neither can hold readings
+    from the current chunk window or newer then archive_age, so those are
+    not looked up
+    """
+    now = datetime.datetime.now()
+    if date_added >= chunk_start(now, int(config['chunk_interval'])) and \
+       (config['archive_dir'] is None or
+            date_added >= now - datetime.timedelta(seconds=float(config['archive_age']))):
+        return False
+
+    # Chunks do not overlap, so only the last one starting before the reading can have it
+    chunk = db.session.query(SensorDataChunk.id, SensorDataChunk.end, SensorDataChunk.count)\
+                      .filter(SensorDataChunk.sensor_id == sensor_id)\
+                      .filter(SensorDataChunk.start <= date_added)\
+                      .order_by(SensorDataChunk.start.desc()).first()
+    if chunk is not None and chunk.end >= date_added:
+        # A client resending a window hits the same chunk for every reading, so
+        # only decode it once. The count changes if compaction adds to the chunk
+        chunk_times = compacted_chunk_times.get((chunk.id, chunk.count))
+        if chunk_times is None:
+            data, count = db.session.query(SensorDataChunk.data, SensorDataChunk.count)\
+                                    .filter(SensorDataChunk.id == chunk.id).one()
+            # The timestamps come first, so the values do not need decoding
+            chunk_times = frozenset(read_deltas(BitReader(data), count))
+            compacted_chunk_times.add((chunk.id, count), chunk_times)
+        if datetime_to_epoch_us(date_added) in chunk_times:
+            return True
+
+    for _ in iter_archive_points(sensor_id, date_added, date_added):
+        return True
+    return False
+
+
+def is_duplicate_reading(sensor_id, date_added):
+    if seen_readings.get((sensor_id, date_added)) is not None:
+        return True
+    # Uses the (sensor_id, date_added) index
+    if db.session.query(SensorData.query.filter_by(sensor_id=sensor_id, date_added=date_added)
+                                        .exists()).scalar():
+        return True
+    return in_compacted_storage(sensor_id, date_added)
+
+
 #######################
 # API Method Decorators
 #######################
@@ -539,10 +1285,15 @@ def authenticate_api(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         try:
-            # Get apikey and check it against the database
             apikey = request.args['apikey']
+            # Limit before the lookup so a client looping on its key does not cost a query each time
+            retry_after = rate_limit_wait('apikey', apikey)
+            if retry_after:
+                return rate_limited_response('apikey', retry_after)
+            # Get apikey and check it against the database
             found_key = ApiKey.query.filter_by(key=apikey).scalar()
             if found_key is not None:
+                g.apikey = found_key
                 # If valid, return
                 return func(*args, **kwargs)
             # If invalid, abort
@@ -638,14 +1389,45 @@ class APIAddSensorData(Resource):
         try:
             sensor_key = request.args['key']
             value = request.args['value']
+
+            date_added = None
+            if 'timestamp' in request.args:
+                try:
+                    date_added = stored_timestamp(parse_timestamp(request.args['timestamp']))
+                except ValueError:
+                    rdata['message'] = "Invalid timestamp: {}".format(request.args['timestamp'])
+                    return rdata
+
+            # A retry with the same idempotency key gets the first response back
+            idempotency_key = request.args.get('idempotency_key')
+            if idempotency_key is not None:
+                idempotency_key = (request.args['apikey'], idempotency_key)
+                previous_rdata = idempotency_keys.get(idempotency_key)
+                if previous_rdata is not None:
+                    return previous_rdata
+
+            retry_after = rate_limit_wait('sensor', sensor_key)
+            if retry_after:
+                return rate_limited_response('sensor', retry_after)
             # Add sensor data to db
             sensor = Sensor.query.filter_by(key=sensor_key).scalar()
-            sensor_data = SensorData(value)
-            sensor_data.sensor = sensor
+            if date_added is not None and is_duplicate_reading(sensor.id, date_added):
+                rdata['message'] = "Duplicate reading"
+            else:
+                sensor_data = SensorData(value, date_added)
+                sensor_data.sensor = sensor
+                # Read before the commit expires them
+                sensor_id, group_id, data_type = sensor.id, sensor.group_id, sensor.data_type
 
-            db.session.add(sensor_data)
-            db.session.commit()
+                db.session.add(sensor_data)
+                db.session.commit()
+                if date_added is not None:
+                    seen_readings.add((sensor_id, date_added))
+                reading_added(sensor_id, group_id, data_type, date_added, value)
             rdata['success'] = True
+
+            if idempotency_key is not None:
+                idempotency_keys.add(idempotency_key, rdata)
         except KeyError:
             logger.info("You are missing the key/value")
             rdata['message'] = "You are missing the key/value"
@@ -675,6 +1457,15 @@ class APIAddGroupData(Resource):
                  }
         try:
             group_key = request.args['key']
+
+            # A retry with the same idempotency key gets the first response back
+            idempotency_key = request.args.get('idempotency_key')
+            if idempotency_key is not None:
+                idempotency_key = (request.args['apikey'], idempotency_key)
+                previous_rdata = idempotency_keys.get(idempotency_key)
+                if previous_rdata is not None:
+                    return previous_rdata
+
             group = Group.query.filter_by(key=group_key).scalar()
             sensors = request.json
 
@@ -682,6 +1473,14 @@ class APIAddGroupData(Resource):
             for data in sensors:
                 try:
                     value = data['value']
+                    date_added = None
+                    if 'timestamp' in data:
+                        try:
+                            date_added = stored_timestamp(parse_timestamp(data['timestamp']))
+                        except (TypeError, ValueError):
+                            rdata['success'] = False
+                            rdata['message'] += "Invalid timestamp: {}\n".format(data['timestamp'])
+                            continue
                     # Check if sensor is in group
                     if 'sensor' in data:
                         # Use sensor key to add value
@@ -695,19 +1494,32 @@ class APIAddGroupData(Resource):
                                              .filter(Sensor.name.ilike(sensor_id)).scalar()
 
                     if sensor is None:
-                        logger.warning("Invalid sensor key {}".format(sensor_id))
+                        logger.warning("Invalid sensor key %s", sensor_id)
                         rdata['success'] = False
                         rdata['message'] += "Invalid sensor: {}\n".format(sensor_id)
+                    elif date_added is not None and is_duplicate_reading(sensor.id, date_added):
+                        rdata['message'] += "Duplicate value for sensor: {}\n".format(sensor_id)
+                    elif rate_limit_wait('sensor', sensor.key):
+                        rdata['success'] = False
+                        rdata['message'] += "Rate limit exceeded for sensor: {}\n".format(sensor_id)
                     else:
-                        sensor_data = SensorData(value)
+                        sensor_data = SensorData(value, date_added)
                         sensor_data.sensor = sensor
+                        # Read before the commit expires them
+                        reading = (sensor.id, sensor.group_id, sensor.data_type, date_added, value)
                         db.session.add(sensor_data)
+                        db.session.commit()
+                        if date_added is not None:
+                            seen_readings.add((reading[0], date_added))
+                        reading_added(*reading)
                         rdata['message'] += "Added value for sensor: {}\n".format(sensor_id)
                 except KeyError:
                     logger.warning("Need both sensor value and group key", exc_info=True)
                     rdata['success'] = False
                     rdata['message'] += "Need both sensor value and group key\n"
-                db.session.commit()
+
+            if idempotency_key is not None:
+                idempotency_keys.add(idempotency_key, rdata)
         except KeyError:
             logger.warning("You are missing the group key", exc_info=True)
             rdata['success'] = False
@@ -720,8 +1532,57 @@ class APIAddGroupData(Resource):
         return rdata
 
 
+class APIAddGroupsFromTemplate(Resource):
+    method_decorators = [authenticate_api]
+
+    def post(self):
+        rdata = {'success': False,
+                 'message': "",
+                 'data': None,
+                 }
+        try:
+            user_id = g.apikey.user_id
+            template_name = request.json['template']
+            if not isinstance(request.json['groups'], list):
+                rdata['message'] = "groups must be a list of group names"
+                return rdata
+            names = [name.strip() if isinstance(name, str) else name for name in request.json['groups']]
+
+            template = GroupTemplate.query.filter_by(user_id=user_id)\
+                                          .filter_by(name=template_name).scalar()
+            if template is None:
+                rdata['message'] = "Invalid template: {}".format(template_name)
+                return rdata
+
+            rdata['message'] = check_new_group_names(user_id, names)
+            if rdata['message'] is not None:
+                return rdata
+
+            groups = create_groups_from_template(user_id, template.id, names)
+            group_sensors = get_group_sensors(groups)
+            rdata['data'] = []
+            for group in groups:
+                rdata['data'].append({'name': group.name,
+                                      'key': group.key,
+                                      'sensors': [{'name': sensor.name, 'key': sensor.key}
+                                                  for sensor in group_sensors[group.id]],
+                                      })
+            rdata['message'] = ""
+            rdata['success'] = True
+        except (KeyError, TypeError):
+            logger.warning("Need both template and groups", exc_info=True)
+            rdata['message'] = "Need both template and groups"
+        except Exception:
+            logger.exception("[APIAddGroupsFromTemplate POST] Oops, something went wrong creating your groups")
+            db.session.rollback()
+            rdata['message'] = "Oops, something went wrong creating your groups"
+
+        return rdata
+
+
 class APIGetSensorData(Resource):
-    method_decorators = [validate_api_sensor_key, authenticate_api]
+    # Authenticate against the primary, then read from a replica
+    method_decorators = [use_read_replica, validate_api_sensor_key, authenticate_api]
 
     def get(self):
         rdata = {'success': False,
@@ -742,15 +1603,19 @@ class APIGetSensorData(Resource):
                 try:
                     limit = abs(int(request.args['limit']))
                 except Exception:
-                    logger.warning("Invalid sensor limit \"{}\""
-                                   .format(request.args['limit']), exc_info=True)
+                    logger.warning("Invalid sensor limit \"%s\"",
+                                   request.args['limit'], exc_info=True)
                     rdata['message'] = "Invalid limit: {}".format(request.args['limit'])
                     return rdata
 
+            # Return values as parallel timestamps/values arrays
+            columnar = request.args.get('format') == 'columnar'
+
             if 'key' in request.args:
                 # Requesting a single sensor
                 sensor_key = request.args['key']
-                rdata['data'] = get_sensor_data(sensor_key, limit=limit, sort_by=sort_by)
+                rdata['data'] = get_sensor_data(sensor_key, limit=limit, sort_by=sort_by,
+                                                columnar=columnar)
                 rdata['success'] = True
             else:
                 rdata['message'] = "Must pass in a sensor key"
@@ -762,7 +1627,8 @@ class APIGetSensorData(Resource):
 
 
 class APIGetGroupData(Resource):
-    method_decorators = [validate_api_group_key, authenticate_api]
+    # Authenticate against the primary, then read from a replica
+    method_decorators = [use_read_replica, validate_api_group_key, authenticate_api]
 
     def get(self):
         rdata = {'success': False,
@@ -770,6 +1636,10 @@ class APIGetGroupData(Resource):
                  'data': None,
                  }
         try:
+            if 'align' in request.args and 'key' in request.args:
+                # Return the sensors as a single table of rows
+                return get_aligned_group_data(request.args['key'])
+
             # Default sort_by
             sort_by = 'desc'
             if 'sort_by' in request.args:
@@ -792,11 +1662,14 @@ class APIGetGroupData(Resource):
                         limit = limit_raw
                     limit = abs(int(limit))
                 except Exception:
-                    logger.warning("Invalid sensor limit \"{}\""
-                                   .format(request.args['limit']), exc_info=True)
+                    logger.warning("Invalid sensor limit \"%s\"",
+                                   request.args['limit'], exc_info=True)
                     rdata['message'] = "Invalid limit: {}".format(limit)
                     return rdata
 
+            # Return values as parallel timestamps/values arrays
+            columnar = request.args.get('format') == 'columnar'
+
             if 'key' in request.args:
                 # Requesting all sensors in a group
                 group_key = request.args['key']
@@ -810,10 +1683,12 @@ class APIGetGroupData(Resource):
 
                 for sensor in group_sensors:
                     if limit_sensor is None:
-                        rdata['data'].append(get_sensor_data(sensor.key, limit=limit, sort_by=sort_by))
+                        rdata['data'].append(get_sensor_data(sensor.key, limit=limit, sort_by=sort_by,
+                                                             columnar=columnar))
                     else:
                         if limit_sensor.lower() == sensor.name.lower():
-                            rdata['data'].append(get_sensor_data(sensor.key, limit=limit, sort_by=sort_by))
+                            rdata['data'].append(get_sensor_data(sensor.key, limit=limit, sort_by=sort_by,
+                                                                 columnar=columnar))
                         else:
                             filter_sensors.append(sensor)
 
@@ -821,14 +1696,18 @@ class APIGetGroupData(Resource):
                 if limit_sensor is not None and sort_by == 'desc':
                     try:
                         # Get oldest item in limit_sensor
-                        oldest_time = rdata['data'][0]['values'][-1]['timestamp']
+                        if columnar:
+                            oldest_time = epoch_ms_to_datetime(rdata['data'][0]['timestamps'][-1])
+                        else:
+                            oldest_time = rdata['data'][0]['values'][-1]['timestamp']
                     except IndexError:
                         rdata['success'] = True
                         rdata['message'] = "No data for limit sensor: {}".format(limit_sensor)
                         return rdata
 
                     for sensor in filter_sensors:
-                        rdata['data'].append(get_sensor_data(sensor.key, sort_by=sort_by, date=oldest_time))
+                        rdata['data'].append(get_sensor_data(sensor.key, sort_by=sort_by, date=oldest_time,
+                                                             columnar=columnar))
 
                 rdata['success'] = True
             else:
@@ -842,23 +1721,49 @@ class APIGetGroupData(Resource):
 
 
 class APIGetGroupList(Resource):
-    method_decorators = [authenticate_api]
+    # Authenticate against the primary, then read from a replica
+    method_decorators = [use_read_replica, authenticate_api]
 
     def get(self):
         rdata = {'success': False,
                  'message': "",
                  'data': None,
+                 'next_cursor': None,
                  }
         try:
-            name_filter = None
+            try:
+                limit = min(abs(int(request.args.get('limit', 100))), 1000)
+                if limit < 1:
+                    raise ValueError
+            except ValueError:
+                rdata['message'] = "Invalid limit: {}".format(request.args['limit'])
+                return rdata
+
+            # Only list the groups of the user the api key belongs to
+            groups = Group.query.filter_by(user_id=g.apikey.user_id)
+
             if 'filter' in request.args:
-                name_filter = request.args['filter']
+                name_filter = escape_like(request.args['filter'])
+                if request.args.get('match') == 'prefix':
+                    # Can use the (user_id, name) index
+                    groups = groups.filter(Group.name.like(name_filter + "%", escape='\\'))
+                else:
+                    groups = groups.filter(Group.name.like("%" + name_filter + "%", escape='\\'))
+
+            if 'cursor' in request.args:
+                try:
+                    last_name, last_id = decode_cursor(request.args['cursor'], (str, int))
+                except (TypeError, ValueError):
+                    rdata['message'] = "Invalid cursor"
+                    return rdata
+                groups = groups.filter(db.or_(Group.name > last_name,
+                                              db.and_(Group.name == last_name, Group.id > last_id)))
+
+            groups = groups.order_by(Group.name.asc(), Group.id.asc()).limit(limit + 1).all()
+            if len(groups) > limit:
+                groups = groups[:limit]
+                rdata['next_cursor'] = encode_cursor([groups[-1].name, groups[-1].id])
 
-            # Requesting all sensors in a group
-            if name_filter is not None:
-                groups = Group.query.filter(Group.name.like("%" + name_filter + "%")).all()
-            else:
-                groups = Group.query.all()
             rdata['data'] = []
             for group in groups:
                 group_dict = {'name': group.name, 'key': group.key}
@@ -872,37 +1777,277 @@ class APIGetGroupList(Resource):
         return rdata
 
 
-api.add_resource(APIAddGroupData, '/add/group')
-api.add_resource(APIAddSensorData, '/add/sensor')
-api.add_resource(APIGetGroupList, '/get/groups')
-api.add_resource(APIGetGroupData, '/get/group')
-api.add_resource(APIGetSensorData, '/get/sensor')
-
-
-#######################
-# API Utils
-#######################
-def get_sensor_data(sensor_key, limit=None, sort_by='desc', date=None):
-    data = {}
-    data['errors'] = {}
+class APIGetSensorStats(Resource):
+    # Authenticate against the primary, then read from a replica
+    method_decorators = [use_read_replica, validate_api_sensor_key, authenticate_api]
 
-    # Get sensor to find what data type the values are
-    sensor = Sensor.query.filter_by(key=sensor_key).scalar()
+    def get(self):
+        rdata = {'success': False,
+                 'message': "",
+                 'data': None,
+                 }
+        try:
+            try:
+                start = parse_timestamp(request.args['start']) if 'start' in request.args else None
+                end = parse_timestamp(request.args['end']) if 'end' in request.args else None
+            except ValueError:
+                rdata['message'] = "Invalid start or end timestamp"
+                return rdata
 
-    # Get all of the data for that sensor
-    if sort_by == 'asc':
-        sensor_data = SensorData.query.filter_by(sensor=sensor)\
-                                      .order_by(SensorData.date_added.asc())\
-                                      .limit(limit)
-    else:
-        if date is not None:
-            # Filter by date
-            # Convert string dat to dattime object to be used to search in the database
             try:
-                date = datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%f%z")
+                percentiles = [float(p) for p in request.args.get('percentiles', '50,90,95,99').split(',')]
+                if any(p < 0 or p > 100 for p in percentiles):
+                    raise ValueError
             except ValueError:
-                date = datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S%z")
+                rdata['message'] = "Invalid percentiles: {}".format(request.args['percentiles'])
+                return rdata
 
+            sensor = Sensor.query.filter_by(key=request.args['key']).scalar()
+            if sensor.data_type not in ('int', 'float'):
+                rdata['message'] = "Stats are only kept for int and float sensors"
+                return rdata
+
+            rdata['data'] = get_sensor_stats(sensor, start, end).to_dict(percentiles)
+            rdata['success'] = True
+        except Exception:
+            logger.exception("[APIGetSensorStats GET] Oops, something went wrong getting your sensor stats")
+            rdata['message'] = "Oops, something went wrong getting your sensor stats"
+
+        return rdata
+
+
+class APIAddRule(Resource):
+    method_decorators = [authenticate_api]
+
+    def post(self):
+        rdata = {'success': False,
+                 'message': "",
+                 'data': None,
+                 }
+        try:
+            user_id = g.apikey.user_id
+            rule = SensorRule(request.json['kind'])
+            rule.user_id = user_id
+
+            # A rule is attached to a single sensor or to every sensor in a group
+            if request.json.get('sensor') is not None:
+                sensor = Sensor.query.filter_by(key=request.json['sensor'], user_id=user_id).scalar()
+                if sensor is None:
+                    rdata['message'] = "Invalid sensor key"
+                    return rdata
+                rule.sensor_id = sensor.id
+            elif request.json.get('group') is not None:
+                group = Group.query.filter_by(key=request.json['group'], user_id=user_id).scalar()
+                if group is None:
+                    rdata['message'] = "Invalid group key"
+                    return rdata
+                rule.group_id = group.id
+            else:
+                rdata['message'] = "Need a sensor or group key"
+                return rdata
+
+            if rule.kind == 'threshold':
+                rule.operator = request.json['operator']
+                if rule.operator not in OPERATORS:
+                    rdata['message'] = "Invalid operator: {}".format(rule.operator)
+                    return rdata
+                rule.threshold = float(request.json['threshold'])
+                rule.duration = abs(int(request.json.get('duration', 0)))
+            elif rule.kind == 'derived':
+                # Every sensor in a group would write its own series into the one target
+                if rule.sensor_id is None:
+                    rdata['message'] = "Derived rules need a sensor key, not a group key"
+                    return rdata
+                rule.function = request.json['function']
+                if rule.function not in DERIVED_FUNCTIONS:
+                    rdata['message'] = "Invalid function: {}".format(rule.function)
+                    return rdata
+                target = Sensor.query.filter_by(key=request.json['target'], user_id=user_id).scalar()
+                if target is None or target.data_type != 'float':
+                    rdata['message'] = "Target must be one of your float sensors"
+                    return rdata
+                if target.id == rule.sensor_id:
+                    rdata['message'] = "Target must be a different sensor"
+                    return rdata
+                rule.target_sensor_id = target.id
+            else:
+                rdata['message'] = "Invalid kind: {}".format(rule.kind)
+                return rdata
+
+            db.session.add(rule)
+            db.session.commit()
+            rule_engine.clear_cache()
+
+            rdata['data'] = {'id': rule.id}
+            rdata['success'] = True
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Invalid rule", exc_info=True)
+            rdata['message'] = "Invalid rule"
+        except Exception:
+            logger.exception("[APIAddRule POST] Oops, something went wrong adding your rule")
+            db.session.rollback()
+            rdata['message'] = "Oops, something went wrong adding your rule"
+
+        return rdata
+
+
+class APIGetRules(Resource):
+    method_decorators = [authenticate_api]
+
+    def get(self):
+        rdata = {'success': False,
+                 'message': "",
+                 'data': None,
+                 }
+        try:
+            rules = SensorRule.query.filter_by(user_id=g.apikey.user_id)\
+                                    .order_by(SensorRule.id.asc()).all()
+
+            # Look up the sensor and group keys in two queries
+            sensor_ids = ({rule.sensor_id for rule in rules} |
+                          {rule.target_sensor_id for rule in rules}) - {None}
+            group_ids = {rule.group_id for rule in rules} - {None}
+            sensor_keys = {}
+            if sensor_ids:
+                sensor_keys = dict(db.session.query(Sensor.id, Sensor.key)
+                                             .filter(Sensor.id.in_(sensor_ids)).all())
+            group_keys = {}
+            if group_ids:
+                group_keys = dict(db.session.query(Group.id, Group.key)
+                                            .filter(Group.id.in_(group_ids)).all())
+
+            rdata['data'] = []
+            for rule in rules:
+                rule_dict = rule.to_dict()
+                rule_dict['sensor'] = sensor_keys.get(rule.sensor_id)
+                rule_dict['group'] = group_keys.get(rule.group_id)
+                rule_dict['target'] = sensor_keys.get(rule.target_sensor_id)
+                rdata['data'].append(rule_dict)
+
+            rdata['success'] = True
+        except Exception:
+            logger.exception("[APIGetRules GET] Oops, something went wrong getting your rules")
+            rdata['message'] = "Oops, something went wrong getting your rules"
+
+        return rdata
+
+
+class APIDeleteRule(Resource):
+    method_decorators = [authenticate_api]
+
+    def post(self):
+        rdata = {'success': False,
+                 'message': "",
+                 'data': None,
+                 }
+        try:
+            rule = SensorRule.query.filter_by(id=int(request.json['id']), user_id=g.apikey.user_id).scalar()
+            if rule is None:
+                rdata['message'] = "Invalid rule id"
+                return rdata
+
+            rule_id = rule.id
+            db.session.delete(rule)
+            db.session.commit()
+            rule_engine.forget_rule(rule_id)
+            rdata['success'] = True
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Invalid rule id", exc_info=True)
+            rdata['message'] = "Invalid rule id"
+        except Exception:
+            logger.exception("[APIDeleteRule POST] Oops, something went wrong deleting your rule")
+            db.session.rollback()
+            rdata['message'] = "Oops, something went wrong deleting your rule"
+
+        return rdata
+
+
+class APIGetEvents(Resource):
+    # Authenticate against the primary, then read from a replica
+    method_decorators = [use_read_replica, validate_api_sensor_key, authenticate_api]
+
+    def get(self):
+        rdata = {'success': False,
+                 'message': "",
+                 'data': None,
+                 }
+        try:
+            try:
+                limit = abs(int(request.args.get('limit', 100)))
+            except ValueError:
+                rdata['message'] = "Invalid limit: {}".format(request.args['limit'])
+                return rdata
+
+            sensor = Sensor.query.filter_by(key=request.args['key']).scalar()
+            events = SensorEvent.query.filter_by(sensor_id=sensor.id)\
+                                      .order_by(SensorEvent.date_added.desc()).limit(limit).all()
+
+            rdata['data'] = []
+            for event in events:
+                rdata['data'].append({'rule': event.rule_id,
+                                      'kind': event.kind,
+                                      'value': event.value,
+                                      'timestamp': datetime_to_str(event.date_added),
+                                      })
+
+            rdata['success'] = True
+        except Exception:
+            logger.exception("[APIGetEvents GET] Oops, something went wrong getting your events")
+            rdata['message'] = "Oops, something went wrong getting your events"
+
+        return rdata
+
+
+class APIRateLimitMetrics(Resource):
+    method_decorators = [authenticate_api]
+
+    def get(self):
+        # The counts cover every user, so only the operators keys can read them
+        if g.apikey.key not in config['metrics_apikeys']:
+            abort(403)
+        rdata = {'success': True,
+                 'message': "",
+                 'data': rate_limit_metrics,
+                 }
+        return rdata
+
+
+api.add_resource(APIAddGroupData, '/add/group')
+api.add_resource(APIAddGroupsFromTemplate, '/add/groups')
+api.add_resource(APIAddRule, '/add/rule')
+api.add_resource(APIAddSensorData, '/add/sensor')
+api.add_resource(APIGetGroupList, '/get/groups')
+api.add_resource(APIGetGroupData, '/get/group')
+api.add_resource(APIGetSensorData, '/get/sensor')
+api.add_resource(APIGetSensorStats, '/get/sensor/stats')
+api.add_resource(APIGetRules, '/get/rules')
+api.add_resource(APIGetEvents, '/get/events')
+api.add_resource(APIDeleteRule, '/delete/rule')
+api.add_resource(APIRateLimitMetrics, '/metrics/ratelimit')
+
+
+#######################
+# API Utils
+#######################
+def get_sensor_data(sensor_key, limit=None, sort_by='desc', date=None, columnar=False):
+    data = {}
+    data['errors'] = {}
+
+    # Get sensor to find what data type the values are
+    sensor = Sensor.query.filter_by(key=sensor_key).scalar()
+
+    # Convert string dat to dattime object to be used to search in the database
+    if isinstance(date, str):
+        date = parse_timestamp(date)
+
+    # Get all of the data for that sensor
+    if sort_by == 'asc':
+        sensor_data = SensorData.query.filter_by(sensor=sensor)\
+                                      .order_by(SensorData.date_added.asc())\
+                                      .limit(limit)
+    else:
+        if date is not None:
+            # Filter by date
             sensor_data = SensorData.query.filter_by(sensor=sensor)\
                                           .filter(SensorData.date_added >= date)\
                                           .order_by(SensorData.date_added.desc())\
@@ -925,11 +2070,1777 @@ def get_sensor_data(sensor_key, limit=None, sort_by='desc', date=None):
                       'data_type': sensor.data_type
                       }
 
-    data['values'], data['errors']['values'] = get_value_list(sensor_data, sensor.data_type)
+    # Merge the rows still in sensor_data with the compressed chunks and the archive
+    convert = convert_value(sensor.data_type)
+    archived = iter_archive_points(sensor.id, start=date, reverse=sort_by != 'asc')
+    points = heapq.merge(((row.date_added, convert(row.value), row.value) for row in sensor_data),
+                         get_chunk_points(sensor, limit=limit, sort_by=sort_by, date=date),
+                         ((timestamp, convert(value), value) for timestamp, value in archived),
+                         key=lambda point: point[0], reverse=sort_by != 'asc')
+    points = itertools.islice(points, limit)
+
+    if columnar:
+        data['timestamps'], data['values'], data['errors']['values'] = \
+            get_value_columns(points, sensor.data_type)
+    else:
+        data['values'], data['errors']['values'] = get_value_list(points, sensor.data_type)
 
     return data
 
 
+@api.representation('application/x-msgpack')
+def output_msgpack(data, code, headers=None):
+    if msgpack is None:
+        # Fall back to json if msgpack is not installed
+        return api.representations['application/json'](data, code, headers)
+
+    resp = make_response(msgpack.packb(data, use_bin_type=True), code)
+    resp.headers.extend(headers or {})
+    resp.headers['Content-Type'] = 'application/x-msgpack'
+    return resp
+
+
+#######################
+# Chunk Storage
+#######################
+# Readings are kept row per point in sensor_data until their chunk_interval
+# window is closed, then compact_sensor_data packs each window into a single
+# SensorDataChunk. Timestamps are stored as delta-of-deltas, floats are XOR'd
+# with the previous value and booleans are run length encoded.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Ints are only compacted inside this range so their delta-of-deltas fit in 64 bits
+INT_CHUNK_LIMIT = 2**60
+
+# (prefix, prefix bits, value bits) for the variable length delta-of-delta encoding
+DOD_BUCKETS = ((0b10, 2, 14), (0b110, 3, 20), (0b1110, 4, 32), (0b1111, 4, 64))
+
+
+class BitWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.bits = 0
+        self.nbits = 0
+
+    def write(self, value, nbits):
+        # Negative values are written as nbits two's complement
+        self.bits = (self.bits << nbits) | (value & ((1 << nbits) - 1))
+        self.nbits += nbits
+        while self.nbits >= 8:
+            self.nbits -= 8
+            self.buffer.append((self.bits >> self.nbits) & 0xFF)
+        self.bits &= (1 << self.nbits) - 1
+
+    def getvalue(self):
+        if self.nbits:
+            return bytes(self.buffer) + bytes([(self.bits << (8 - self.nbits)) & 0xFF])
+        return bytes(self.buffer)
+
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, nbits):
+        value = 0
+        while nbits:
+            offset = self.pos & 7
+            take = min(8 - offset, nbits)
+            byte = self.data[self.pos >> 3]
+            value = (value << take) | ((byte >> (8 - offset - take)) & ((1 << take) - 1))
+            self.pos += take
+            nbits -= take
+        return value
+
+    def read_signed(self, nbits):
+        value = self.read(nbits)
+        if value >= 1 << (nbits - 1):
+            value -= 1 << nbits
+        return value
+
+
+def write_dod(writer, value):
+    if value == 0:
+        writer.write(0, 1)
+        return
+    for prefix, prefix_bits, value_bits in DOD_BUCKETS:
+        limit = 1 << (value_bits - 1)
+        if -limit <= value < limit:
+            writer.write(prefix, prefix_bits)
+            writer.write(value, value_bits)
+            return
+    raise ValueError("Value {} is too large to encode".format(value))
+
+
+def read_dod(reader):
+    if reader.read(1) == 0:
+        return 0
+    for bucket in range(len(DOD_BUCKETS) - 1):
+        if reader.read(1) == 0:
+            break
+    else:
+        bucket = len(DOD_BUCKETS) - 1
+    return reader.read_signed(DOD_BUCKETS[bucket][2])
+
+
+def datetime_to_epoch_us(timestamp):
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+
+
+def epoch_us_to_datetime(epoch_us):
+    return EPOCH + datetime.timedelta(microseconds=epoch_us)
+
+
+def write_deltas(writer, values):
+    """
+    First value in 64 bits, then the delta-of-delta of each value after it
+    """
+    prev_value = values[0]
+    prev_delta = 0
+    writer.write(prev_value, 64)
+    for value in values[1:]:
+        delta = value - prev_value
+        write_dod(writer, delta - prev_delta)
+        prev_value, prev_delta = value, delta
+
+
+def read_deltas(reader, count):
+    value = reader.read_signed(64)
+    delta = 0
+    values = [value]
+    for _ in range(count - 1):
+        delta += read_dod(reader)
+        value += delta
+        values.append(value)
+    return values
+
+
+def write_floats(writer, values):
+    prev_bits = struct.unpack('>Q', struct.pack('>d', values[0]))[0]
+    writer.write(prev_bits, 64)
+    prev_leading = prev_trailing = None
+    for value in values[1:]:
+        bits = struct.unpack('>Q', struct.pack('>d', value))[0]
+        xor = bits ^ prev_bits
+        prev_bits = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+
+        writer.write(1, 1)
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if prev_leading is not None and leading >= prev_leading and trailing >= prev_trailing:
+            # The meaningful bits fit in the previous window
+            writer.write(0, 1)
+            writer.write(xor >> prev_trailing, 64 - prev_leading - prev_trailing)
+        else:
+            length = 64 - leading - trailing
+            writer.write(1, 1)
+            writer.write(leading, 5)
+            writer.write(length - 1, 6)
+            writer.write(xor >> trailing, length)
+            prev_leading, prev_trailing = leading, trailing
+
+
+def read_floats(reader, count):
+    bits = reader.read(64)
+    values = [struct.unpack('>d', struct.pack('>Q', bits))[0]]
+    leading = trailing = 0
+    for _ in range(count - 1):
+        if reader.read(1) == 1:
+            if reader.read(1) == 1:
+                leading = reader.read(5)
+                trailing = 64 - leading - (reader.read(6) + 1)
+            bits ^= reader.read(64 - leading - trailing) << trailing
+        values.append(struct.unpack('>d', struct.pack('>Q', bits))[0])
+    return values
+
+
+def write_booleans(writer, values):
+    """
+    First value in 1 bit, then the length of each run of the same value
+    """
+    writer.write(int(values[0]), 1)
+    for _, run in itertools.groupby(values):
+        write_dod(writer, sum(1 for _ in run))
+
+
+def read_booleans(reader, count):
+    value = bool(reader.read(1))
+    values = []
+    while len(values) < count:
+        values.extend([value] * read_dod(reader))
+        value = not value
+    return values
+
+
+# data_type -> (value writer, value reader, check if a converted value can be stored)
+CHUNK_ENCODINGS = {'float': (write_floats, read_floats,
+                             lambda value: isinstance(value, float)),
+                   'int': (write_deltas, read_deltas,
+                           lambda value: -INT_CHUNK_LIMIT < value < INT_CHUNK_LIMIT),
+                   'boolean': (write_booleans, read_booleans,
+                               lambda value: isinstance(value, bool)),
+                   }
+
+
+def encode_chunk(points, encoding):
+    """
+    :param points: list of (timestamp, value) sorted by timestamp
+    """
+    writer = BitWriter()
+    write_deltas(writer, [datetime_to_epoch_us(timestamp) for timestamp, _ in points])
+    CHUNK_ENCODINGS[encoding][0](writer, [value for _, value in points])
+    return writer.getvalue()
+
+
+def decode_chunk(data, count, encoding):
+    """
+    :returns: list of (timestamp, value) sorted by timestamp
+    """
+    reader = BitReader(data)
+    timestamps = [epoch_us_to_datetime(epoch_us) for epoch_us in read_deltas(reader, count)]
+    return list(zip(timestamps, CHUNK_ENCODINGS[encoding][1](reader, count)))
+
+
+def chunk_start(timestamp, interval):
+    epoch_us = datetime_to_epoch_us(timestamp)
+    return epoch_us_to_datetime(epoch_us - epoch_us % (interval * 10**6))
+
+
+def get_chunk_points(sensor, limit=None, sort_by='desc', date=None):
+    """
+    Decode the sensors chunks, stopping once `limit` points have been found
+    :returns: list of (timestamp, value, value) sorted by sort_by
+    """
+    chunks = SensorDataChunk.query.filter_by(sensor_id=sensor.id)
+    if date is not None:
+        chunks = chunks.filter(SensorDataChunk.end >= date)
+    if sort_by == 'asc':
+        chunks = chunks.order_by(SensorDataChunk.start.asc())
+    else:
+        chunks = chunks.order_by(SensorDataChunk.start.desc())
+
+    points = []
+    for chunk in chunks:
+        chunk_points = decode_chunk(chunk.data, chunk.count, chunk.encoding)
+        if date is not None:
+            chunk_points = [point for point in chunk_points if point[0] >= date]
+        if sort_by != 'asc':
+            chunk_points.reverse()
+        points.extend((timestamp, value, value) for timestamp, value in chunk_points)
+        # Chunks do not overlap so the rest are all past the limit
+        if limit is not None and len(points) >= limit:
+            break
+
+    return points
+
+
+def compact_sensor(sensor, cutoff, interval):
+    """
+    Move the sensors readings older then `cutoff` into chunks, one window at a time
+    Values that can not be converted to the sensors data type stay in sensor_data
+    :returns: number of readings moved
+    """
+    encoding = sensor.data_type
+    convert = convert_value(encoding)
+    can_store = CHUNK_ENCODINGS[encoding][2]
+    window_end = None
+    moved = 0
+    while True:
+        oldest = db.session.query(db.func.min(SensorData.date_added))\
+                           .filter(SensorData.sensor_id == sensor.id)\
+                           .filter(SensorData.date_added < cutoff)
+        if window_end is not None:
+            oldest = oldest.filter(SensorData.date_added >= window_end)
+        oldest = oldest.scalar()
+        if oldest is None:
+            return moved
+
+        start = chunk_start(oldest, interval)
+        window_end = min(start + datetime.timedelta(seconds=interval), cutoff)
+        rows = db.session.query(SensorData.id, SensorData.date_added, SensorData.value)\
+                         .filter(SensorData.sensor_id == sensor.id)\
+                         .filter(SensorData.date_added >= start)\
+                         .filter(SensorData.date_added < window_end)
+
+        ids = []
+        points = []
+        for row_id, date_added, value in rows:
+            value = convert(value)
+            if value is not None and can_store(value):
+                ids.append(row_id)
+                points.append((date_added, value))
+        if not ids:
+            continue
+
+        chunk = SensorDataChunk.query.filter_by(sensor_id=sensor.id, start=start).scalar()
+        if chunk is None:
+            chunk = SensorDataChunk(start, encoding)
+            chunk.sensor_id = sensor.id
+            db.session.add(chunk)
+        else:
+            points.extend(decode_chunk(chunk.data, chunk.count, chunk.encoding))
+        points.sort(key=lambda point: point[0])
+
+        chunk.data = encode_chunk(points, chunk.encoding)
+        chunk.count = len(points)
+        chunk.end = points[-1][0]
+        for i in range(0, len(ids), 500):
+            SensorData.query.filter(SensorData.id.in_(ids[i:i + 500]))\
+                            .delete(synchronize_session=False)
+        db.session.commit()
+        moved += len(ids)
+
+
+def compact_sensor_data(cutoff=None):
+    """
+    Compact every sensor with a data type that can be chunked
+    By default only windows that are closed are compacted
+    """
+    interval = int(config['chunk_interval'])
+    if cutoff is None:
+        cutoff = chunk_start(datetime.datetime.now(), interval)
+
+    moved = 0
+    # Sensors that are being deleted are left to their deletion job
+    sensors = Sensor.query.filter(Sensor.data_type.in_(list(CHUNK_ENCODINGS)))\
+                          .filter(Sensor.user_id.isnot(None))
+    for sensor in sensors.all():
+        try:
+            moved += compact_sensor(sensor, cutoff, interval)
+        except Exception:
+            logger.exception("[compact_sensor_data] Failed to compact sensor %s", sensor.key)
+            db.session.rollback()
+    logger.info("Compacted %s readings into chunks", moved)
+    return moved
+
+
+def run_chunk_compaction():
+    while True:
+        with app.app_context():
+            compact_sensor_data()
+        time.sleep(float(config['chunk_compact_interval']))
+
+
+#######################
+# Archive Storage
+#######################
+# Readings older then archive_age are moved out of sensor_data into per sensor
+# segment files. A segment is a run of records sorted by time, each packed as
+#   epoch us (int64) | value length (uint32) | utf-8 value
+# with a sparse .idx file next to it holding (epoch us, offset) for every
+# ARCHIVE_INDEX_INTERVAL'th record. Files are only appended to, and the
+# archive_segments row says how much of them has been committed, so a write
+# that fails before its commit is ignored by readers and overwritten by the
+# next append.
+ARCHIVE_RECORD = struct.Struct('<qI')
+ARCHIVE_INDEX = struct.Struct('<qQ')
+ARCHIVE_INDEX_INTERVAL = 128
+# Start a new segment once the last one is this many bytes
+ARCHIVE_SEGMENT_SIZE = 64 * 2**20
+
+
+def archive_path(sensor_id, seq=None):
+    path = os.path.join(config['archive_dir'], str(sensor_id))
+    if seq is not None:
+        path = os.path.join(path, '{:08d}'.format(seq))
+    return path
+
+
+def index_entries(count):
+    return -(-count // ARCHIVE_INDEX_INTERVAL)
+
+
+def append_segment(segment, points):
+    """
+    Write the points past the committed end of the segments files and update
+    the segment to match. The caller commits it
+    :param points: list of (timestamp, value string) sorted by timestamp,
+                   none older then the segments end
+    """
+    path = archive_path(segment.sensor_id, segment.seq)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    records = bytearray()
+    index = bytearray()
+    count = segment.count
+    for timestamp, value in points:
+        epoch_us = datetime_to_epoch_us(timestamp)
+        if count % ARCHIVE_INDEX_INTERVAL == 0:
+            index += ARCHIVE_INDEX.pack(epoch_us, segment.size + len(records))
+        value = value.encode('utf-8')
+        records += ARCHIVE_RECORD.pack(epoch_us, len(value))
+        records += value
+        count += 1
+
+    for ext, data, committed in (('.seg', records, segment.size),
+                                 ('.idx', index, index_entries(segment.count) * ARCHIVE_INDEX.size)):
+        with open(path + ext, 'a+b') as f:
+            # Drop anything left by a write that was never committed
+            f.truncate(committed)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    if segment.start is None:
+        segment.start = points[0][0]
+    segment.end = points[-1][0]
+    segment.count = count
+    segment.size += len(records)
+
+
+def read_segment(path, count, size, start=None, end=None, reverse=False):
+    """
+    Binary search the sparse index for the blocks that cover start to end and
+    only decode those from the memory mapped segment
+    :returns: generator of (timestamp, value string) sorted by time, newest first if reverse
+    """
+    with open(path + '.idx', 'rb') as f:
+        index = list(ARCHIVE_INDEX.iter_unpack(f.read(index_entries(count) * ARCHIVE_INDEX.size)))
+    index_times = [epoch_us for epoch_us, _ in index]
+    start_us = datetime_to_epoch_us(start) if start is not None else None
+    end_us = datetime_to_epoch_us(end) if end is not None else None
+
+    # The block before the first one starting at `start` can still end with readings at `start`
+    first = max(bisect.bisect_left(index_times, start_us) - 1, 0) if start_us is not None else 0
+    last = bisect.bisect_right(index_times, end_us) - 1 if end_us is not None else len(index) - 1
+    blocks = range(first, last + 1)
+    if reverse:
+        blocks = reversed(blocks)
+
+    with open(path + '.seg', 'rb') as f:
+        data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        for block in blocks:
+            offset = index[block][1]
+            block_end = index[block + 1][1] if block + 1 < len(index) else size
+            points = []
+            while offset < block_end:
+                epoch_us, length = ARCHIVE_RECORD.unpack_from(data, offset)
+                offset += ARCHIVE_RECORD.size
+                if (start_us is None or epoch_us >= start_us) and (end_us is None or epoch_us <= end_us):
+                    points.append((epoch_us_to_datetime(epoch_us), data[offset:offset + length].decode('utf-8')))
+                offset += length
+            if reverse:
+                points.reverse()
+            yield from points
+    finally:
+        data.close()
+
+
+def iter_archive_points(sensor_id, start=None, end=None, reverse=False):
+    """
+    The sensors archived readings, merged across its segments
+    :returns: iterator of (timestamp, value string) sorted by time, newest first if reverse
+    """
+    if config['archive_dir'] is None:
+        return iter(())
+
+    segments = db.session.query(ArchiveSegment.seq, ArchiveSegment.count, ArchiveSegment.size)\
+                         .filter(ArchiveSegment.sensor_id == sensor_id)\
+                         .filter(ArchiveSegment.count > 0)
+    if start is not None:
+        segments = segments.filter(ArchiveSegment.end >= start)
+    if end is not None:
+        segments = segments.filter(ArchiveSegment.start <= end)
+
+    # Segments only overlap when old readings were added late, so this is mostly a concatenation
+    return heapq.merge(*[read_segment(archive_path(sensor_id, seq), count, size, start, end, reverse)
+                         for seq, count, size in segments.all()],
+                       key=lambda point: point[0], reverse=reverse)
+
+
+def archive_sensor(sensor_id, cutoff, batch_size):
+    """
+    Move the sensors readings older then `cutoff` to the end of its last
+    segment, oldest first, `batch_size` at a time
+    :returns: number of readings moved
+    """
+    moved = 0
+    while True:
+        rows = db.session.query(SensorData.id, SensorData.date_added, SensorData.value)\
+                         .filter(SensorData.sensor_id == sensor_id)\
+                         .filter(SensorData.date_added < cutoff)\
+                         .order_by(SensorData.date_added.asc(), SensorData.id.asc())\
+                         .limit(batch_size).all()
+        if not rows:
+            return moved
+
+        segment = ArchiveSegment.query.filter_by(sensor_id=sensor_id)\
+                                      .order_by(ArchiveSegment.seq.desc()).first()
+        # Readings older then the last segment (added late with an old timestamp)
+        # start a new one so every segment stays sorted
+        if segment is None or segment.size >= ARCHIVE_SEGMENT_SIZE or \
+           (segment.end is not None and rows[0].date_added < segment.end):
+            segment = ArchiveSegment(segment.seq + 1 if segment is not None else 0)
+            segment.sensor_id = sensor_id
+            db.session.add(segment)
+
+        append_segment(segment, [(row.date_added, row.value) for row in rows])
+        for ids in chunked([row.id for row in rows]):
+            SensorData.query.filter(SensorData.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        moved += len(rows)
+
+
+def archive_sensor_data(cutoff=None):
+    """
+    Archive the readings of every sensor older then `archive_age` seconds
+    """
+    if cutoff is None:
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=float(config['archive_age']))
+    batch_size = int(config['archive_batch_size'])
+
+    moved = 0
+    # Sensors that are being deleted are left to their deletion job
+    for sensor_id, in db.session.query(Sensor.id).filter(Sensor.user_id.isnot(None)).all():
+        try:
+            moved += archive_sensor(sensor_id, cutoff, batch_size)
+        except Exception:
+            logger.exception("[archive_sensor_data] Failed to archive sensor %s", sensor_id)
+            db.session.rollback()
+    logger.info("Archived %s readings", moved)
+    return moved
+
+
+def run_archive():
+    while True:
+        with app.app_context():
+            archive_sensor_data()
+        time.sleep(float(config['archive_interval']))
+
+
+def count_archived(sensor_id):
+    return db.session.query(db.func.sum(ArchiveSegment.count))\
+                     .filter(ArchiveSegment.sensor_id == sensor_id).scalar() or 0
+
+
+def purge_archive(sensor_id):
+    """
+    Remove the sensors segments, the rows first so readers stop using the files
+    :returns: number of readings removed
+    """
+    count = count_archived(sensor_id)
+    ArchiveSegment.query.filter_by(sensor_id=sensor_id).delete(synchronize_session=False)
+    db.session.commit()
+    if config['archive_dir'] is not None:
+        shutil.rmtree(archive_path(sensor_id), ignore_errors=True)
+    return count
+
+
+#######################
+# Provisioning
+#######################
+def chunked(items, size=500):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def create_groups_from_template(user_id, group_template_id, names):
+    """
+    Create a group with all of the templates sensors for each name
+
+    Groups and sensors are bulk inserted, read back to get their ids, and
+    keyed with a bulk update, so the number of queries does not depend on
+    the number of sensors. Everything is committed once at the end.
+    :returns: list of the new Groups, in the same order as names
+    """
+    template_sensors = db.session.query(SensorTemplate.name, SensorTemplate.data_type)\
+                                 .filter_by(user_id=user_id)\
+                                 .filter_by(group_template_id=group_template_id).all()
+
+    db.session.execute(Group.__table__.insert(),
+                       [{'name': name, 'user_id': user_id} for name in names])
+    groups = []
+    for names_chunk in chunked(names):
+        groups.extend(Group.query.filter_by(user_id=user_id)
+                                 .filter(Group.name.in_(names_chunk)).all())
+    db.session.bulk_update_mappings(Group, [{'id': group.id,
+                                             'key': generate_key(group.id, 'Group salt abc')}
+                                            for group in groups])
+
+    group_ids = [group.id for group in groups]
+    if template_sensors:
+        now = datetime.datetime.now()
+        db.session.execute(Sensor.__table__.insert(),
+                           [{'name': sensor.name,
+                             'data_type': sensor.data_type,
+                             'user_id': user_id,
+                             'group_id': group_id,
+                             'date_added': now,
+                             }
+                            for group_id in group_ids for sensor in template_sensors])
+        sensor_ids = []
+        for group_ids_chunk in chunked(group_ids):
+            sensor_ids.extend(sensor_id for sensor_id, in db.session.query(Sensor.id)
+                                                               .filter(Sensor.group_id.in_(group_ids_chunk)))
+        db.session.bulk_update_mappings(Sensor, [{'id': sensor_id,
+                                                  'key': generate_key(sensor_id, 'Sensor salt xyz')}
+                                                 for sensor_id in sensor_ids])
+
+    db.session.commit()
+    order = {name: i for i, name in enumerate(names)}
+    groups.sort(key=lambda group: order[group.name])
+    return groups
+
+
+def get_group_sensors(groups):
+    """
+    :returns: dict of group id -> list of its sensors, loaded in as few queries as possible
+    """
+    group_sensors = {group.id: [] for group in groups}
+    for group_ids_chunk in chunked(list(group_sensors)):
+        for sensor in Sensor.query.filter(Sensor.group_id.in_(group_ids_chunk))\
+                                  .order_by(Sensor.name.asc()):
+            group_sensors[sensor.group_id].append(sensor)
+    return group_sensors
+
+
+def check_new_group_names(user_id, names):
+    """
+    :returns: error message if the names can not be used for new groups, otherwise None
+    """
+    if not names or any(not isinstance(name, str) or not name.strip() for name in names):
+        return "Group names can not be empty"
+    max_length = Group.name.type.length
+    too_long = [name for name in names if len(name) > max_length]
+    if too_long:
+        return "Group names can be at most {} characters: {}".format(max_length, ", ".join(too_long))
+    if len(set(names)) != len(names):
+        return "Group names must be unique"
+    existing = []
+    for names_chunk in chunked(names):
+        existing.extend(name for name, in db.session.query(Group.name)
+                                                    .filter_by(user_id=user_id)
+                                                    .filter(Group.name.in_(names_chunk)))
+    if existing:
+        return "Groups already exist: {}".format(", ".join(existing))
+    return None
+
+
+def provision_groups_cli(email, template_name, names_file):
+    """
+    Create a group from a template for every line in names_file and print their keys as csv
+    """
+    user = User.query.filter_by(email=email).scalar()
+    if user is None:
+        print("No user with the email", email)
+        return 1
+    template = GroupTemplate.query.filter_by(user_id=user.id).filter_by(name=template_name).scalar()
+    if template is None:
+        print("No template named", template_name)
+        return 1
+    with open(names_file, 'r') as stream:
+        names = [line.strip() for line in stream if line.strip()]
+
+    error = check_new_group_names(user.id, names)
+    if error is not None:
+        print(error)
+        return 1
+
+    groups = create_groups_from_template(user.id, template.id, names)
+    group_sensors = get_group_sensors(groups)
+    print("group,group_key,sensor,sensor_key")
+    for group in groups:
+        for sensor in group_sensors[group.id]:
+            print("{},{},{},{}".format(group.name, group.key, sensor.name, sensor.key))
+    logger.info("Provisioned %s groups from template %s for %s", len(groups), template_name, email)
+    return 0
+
+
+#######################
+# Background Deletion
+#######################
+# Set when a new job is added so the worker does not wait for its next poll
+deletion_jobs_ready = threading.Event()
+
+
+def purge_rows(model, sensor_id, chunk_size):
+    """
+    Delete the sensors rows from `model` in chunks, committing after each one
+    so no single statement holds a long lock
+    :returns: generator of the number of rows deleted by each chunk
+    """
+    while True:
+        ids = [row_id for row_id, in db.session.query(model.id)
+                                              .filter(model.sensor_id == sensor_id)
+                                              .limit(chunk_size)]
+        if not ids:
+            return
+        model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        yield len(ids)
+
+
+def run_deletion_job(job):
+    chunk_size = int(config['delete_chunk_size'])
+    if job.kind == 'sensor':
+        if job.total is None:
+            job.total = SensorData.query.filter_by(sensor_id=job.target_id).count() + \
+                        SensorDataChunk.query.filter_by(sensor_id=job.target_id).count() + \
+                        count_archived(job.target_id)
+            db.session.commit()
+        for model in (SensorData, SensorDataChunk, SensorStatsBucket, SensorStatsSince, SensorEvent):
+            for deleted in purge_rows(model, job.target_id, chunk_size):
+                if model in (SensorData, SensorDataChunk):
+                    job.deleted = (job.deleted or 0) + deleted
+                    db.session.commit()
+        job.deleted = (job.deleted or 0) + purge_archive(job.target_id)
+        db.session.commit()
+        SensorRule.query.filter(db.or_(SensorRule.sensor_id == job.target_id,
+                                       SensorRule.target_sensor_id == job.target_id))\
+                        .delete(synchronize_session=False)
+        Sensor.query.filter_by(id=job.target_id).delete(synchronize_session=False)
+    elif job.kind == 'group':
+        SensorRule.query.filter_by(group_id=job.target_id).delete(synchronize_session=False)
+        Sensor.query.filter_by(group_id=job.target_id)\
+                    .update({'group_id': None}, synchronize_session=False)
+        Group.query.filter_by(id=job.target_id).delete(synchronize_session=False)
+
+    kind, target_id, name = job.kind, job.target_id, job.name
+    db.session.delete(job)
+    db.session.commit()
+    logger.info("Finished deleting %s %s - %s", kind, target_id, name)
+
+
+def run_deletion_jobs():
+    while True:
+        with app.app_context():
+            for job in DeletionJob.query.order_by(DeletionJob.id.asc()).all():
+                try:
+                    run_deletion_job(job)
+                except Exception:
+                    logger.exception("[run_deletion_jobs] Failed to delete %s %s", job.kind, job.target_id)
+                    db.session.rollback()
+        deletion_jobs_ready.wait(60)
+        deletion_jobs_ready.clear()
+
+
+#######################
+# Aligned Group Data
+#######################
+INTERVAL_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+FILL_POLICIES = ('previous', 'null', 'linear')
+
+
+def parse_interval(interval):
+    """
+    :returns: timedelta for strings like `30`, `30s`, `5m`, `1h` or `1d`, None if it is not an interval
+    """
+    match = re.match(r'^(\d+)([smhd]?)$', interval)
+    if match is None or int(match.group(1)) == 0:
+        return None
+    return datetime.timedelta(seconds=int(match.group(1)) * INTERVAL_UNITS[match.group(2)])
+
+
+def iter_sensor_rows(sensor, start=None, end=None, page_size=1000):
+    """
+    Page through the sensors rows in sensor_data oldest first
+    :returns: generator of (timestamp, converted value)
+    """
+    convert = convert_value(sensor.data_type)
+    query = db.session.query(SensorData.id, SensorData.date_added, SensorData.value)\
+                      .filter(SensorData.sensor_id == sensor.id)
+    if start is not None:
+        query = query.filter(SensorData.date_added >= start)
+    if end is not None:
+        query = query.filter(SensorData.date_added <= end)
+
+    last = None
+    while True:
+        page = query
+        if last is not None:
+            page = page.filter(db.or_(SensorData.date_added > last.date_added,
+                                      db.and_(SensorData.date_added == last.date_added,
+                                              SensorData.id > last.id)))
+        rows = page.order_by(SensorData.date_added.asc(), SensorData.id.asc()).limit(page_size).all()
+        for row in rows:
+            value = convert(row.value)
+            if value is not None:
+                yield row.date_added, value
+        if len(rows) < page_size:
+            return
+        last = rows[-1]
+
+
+def iter_sensor_chunks(sensor, start=None, end=None):
+    """
+    Decode the sensors chunks one at a time oldest first
+    :returns: generator of (timestamp, value)
+    """
+    chunk_ids = db.session.query(SensorDataChunk.id).filter(SensorDataChunk.sensor_id == sensor.id)
+    if start is not None:
+        chunk_ids = chunk_ids.filter(SensorDataChunk.end >= start)
+    if end is not None:
+        chunk_ids = chunk_ids.filter(SensorDataChunk.start <= end)
+
+    for chunk_id, in chunk_ids.order_by(SensorDataChunk.start.asc()).all():
+        chunk = SensorDataChunk.query.get(chunk_id)
+        for timestamp, value in decode_chunk(chunk.data, chunk.count, chunk.encoding):
+            if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                yield timestamp, value
+        # Do not keep the decoded chunks around in the session
+        db.session.expunge(chunk)
+
+
+def iter_sensor_points(sensor, start=None, end=None):
+    """
+    All of the sensors valid values oldest first, without loading them all at once
+    :returns: generator of (timestamp, converted value)
+    """
+    convert = convert_value(sensor.data_type)
+    archived = ((timestamp, convert(value)) for timestamp, value in iter_archive_points(sensor.id, start, end))
+    return heapq.merge(iter_sensor_rows(sensor, start, end),
+                       iter_sensor_chunks(sensor, start, end),
+                       (point for point in archived if point[1] is not None),
+                       key=lambda point: point[0])
+
+
+class AsOfCursor:
+    """
+    Walks a sorted stream of points forward, keeping the last point at or
+    before the current time and the first point after it
+    """
+    def __init__(self, points):
+        self.points = points
+        self.prev = None
+        self.next = next(self.points, None)
+
+    def advance(self, timestamp):
+        while self.next is not None and self.next[0] <= timestamp:
+            self.prev = self.next
+            self.next = next(self.points, None)
+
+    def value(self, timestamp, fill, interval=None):
+        if self.prev is None:
+            return None
+        prev_time, prev_value = self.prev
+        if fill == 'null':
+            # Only use a point that is inside this grid step
+            if prev_time == timestamp or (interval is not None and prev_time > timestamp - interval):
+                return prev_value
+            return None
+        if fill == 'linear' and prev_time != timestamp and self.next is not None and \
+           isinstance(prev_value, (int, float)) and not isinstance(prev_value, bool):
+            next_time, next_value = self.next
+            ratio = (timestamp - prev_time).total_seconds() / (next_time - prev_time).total_seconds()
+            value = prev_value + (next_value - prev_value) * ratio
+            return int(round(value)) if isinstance(prev_value, int) else value
+        return prev_value
+
+
+def align_rows(cursors, grid, fill, interval=None):
+    """
+    As-of join every sensor onto the grid timestamps in a single pass
+    :returns: generator of [timestamp, value per sensor]
+    """
+    for timestamp in grid:
+        row = [datetime_to_str(timestamp)]
+        for cursor in cursors:
+            cursor.advance(timestamp)
+            row.append(cursor.value(timestamp, fill, interval))
+        yield row
+
+
+def interval_grid(cursors, interval, start=None, end=None):
+    """
+    Timestamps every `interval` from the first point until every sensor is out of points
+    """
+    if start is None:
+        first_times = [cursor.next[0] for cursor in cursors if cursor.next is not None]
+        if not first_times:
+            return
+        start = min(first_times)
+        # Line the grid up with the interval
+        start = EPOCH + (start - EPOCH) // interval * interval
+
+    timestamp = start
+    while end is None or timestamp <= end:
+        yield timestamp
+        # The cursors have been advanced to timestamp by the time this resumes
+        if end is None and all(cursor.next is None for cursor in cursors):
+            return
+        timestamp += interval
+
+
+def get_aligned_group_data(group_key):
+    """
+    Stream the groups sensors as a table with a row per grid timestamp, the
+    grid is either a fixed interval or the timestamps of one of the sensors
+    """
+    rdata = {'success': False,
+             'message': "",
+             'data': None,
+             }
+    align = request.args['align']
+    fill = request.args.get('fill', 'previous')
+    if fill not in FILL_POLICIES:
+        rdata['message'] = "Invalid fill: {}".format(fill)
+        return rdata
+
+    try:
+        start = parse_timestamp(request.args['start']) if 'start' in request.args else None
+        end = parse_timestamp(request.args['end']) if 'end' in request.args else None
+    except ValueError:
+        rdata['message'] = "Invalid start or end timestamp"
+        return rdata
+
+    group = Group.query.filter_by(key=group_key).scalar()
+    sensors = Sensor.query.filter_by(group=group).order_by(Sensor.name.asc()).all()
+    interval = parse_interval(align)
+    if interval is None:
+        align_sensor = [sensor for sensor in sensors if sensor.name.lower() == align.lower()]
+        if not align_sensor:
+            rdata['message'] = "Invalid align, must be an interval or sensor name: {}".format(align)
+            return rdata
+        grid = (timestamp for timestamp, _ in iter_sensor_points(align_sensor[0], start, end))
+
+    if interval is not None and end is None:
+        # Bound the grid, it would otherwise run to the newest reading of any sensor
+        end = datetime.datetime.now()
+
+    cursors = [AsOfCursor(iter_sensor_points(sensor, start, end)) for sensor in sensors]
+    if interval is not None:
+        first_times = [cursor.next[0] for cursor in cursors if cursor.next is not None]
+        grid_start = start or (min(first_times) if first_times else end)
+        max_rows = int(config['align_max_rows'])
+        if (end - grid_start) / interval > max_rows:
+            rdata['message'] = "Too many rows, use a larger align interval or a shorter range " \
+                               "(max {} rows)".format(max_rows)
+            return rdata
+        grid = interval_grid(cursors, interval, start, end)
+
+    rows = align_rows(cursors, grid, fill, interval)
+
+    def generate():
+        yield '{"success": true, "message": "", "data": {"columns": '
+        yield json.dumps(['timestamp'] + [sensor.name for sensor in sensors])
+        yield ', "rows": ['
+        separator = ''
+        # Send the rows in batches so each write is not a single row
+        for batch in iter(lambda: list(itertools.islice(rows, 500)), []):
+            yield separator + ', '.join(json.dumps(row) for row in batch)
+            separator = ', '
+        yield ']}}'
+
+    encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+    if encoding is None:
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+    response = Response(stream_with_context(compress_stream(generate(), encoding)),
+                        mimetype='application/json')
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+#######################
+# Sensor Stats
+#######################
+class TDigest:
+    """
+    Merging t-digest, a small mergeable sketch of a distribution that
+    gives approximate quantiles
+    """
+    def __init__(self, compression=100):
+        self.compression = compression
+        # Sorted [mean, weight] pairs
+        self.centroids = []
+        self.buffer = []
+        self.min = None
+        self.max = None
+
+    def add(self, value, weight=1):
+        self.buffer.append([value, weight])
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.buffer) > self.compression * 5:
+            self.compress()
+
+    def merge(self, other):
+        if other.min is None:
+            return
+        self.buffer.extend([mean, weight] for mean, weight in other.centroids + other.buffer)
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.compress()
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _k_inverse(self, k):
+        angle = max(-math.pi / 2, min(math.pi / 2, k * 2 * math.pi / self.compression))
+        return (math.sin(angle) + 1) / 2
+
+    def compress(self):
+        if not self.buffer:
+            return
+        points = sorted(self.centroids + self.buffer)
+        self.buffer = []
+        total = sum(weight for _, weight in points)
+
+        centroids = [list(points[0])]
+        weight_so_far = 0
+        q_limit = self._k_inverse(self._k(0) + 1)
+        for mean, weight in points[1:]:
+            current = centroids[-1]
+            if (weight_so_far + current[1] + weight) / total <= q_limit:
+                current[1] += weight
+                current[0] += (mean - current[0]) * weight / current[1]
+            else:
+                weight_so_far += current[1]
+                q_limit = self._k_inverse(self._k(weight_so_far / total) + 1)
+                centroids.append([mean, weight])
+        self.centroids = centroids
+
+    def quantile(self, q):
+        self.compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+
+        total = sum(weight for _, weight in self.centroids)
+        target = q * total
+        # Each centroid's mean sits at the middle of its weight
+        prev_mean, prev_center = self.min, 0
+        cumulative = 0
+        for mean, weight in self.centroids:
+            center = cumulative + weight / 2
+            if target <= center:
+                if center == prev_center:
+                    return mean
+                return prev_mean + (mean - prev_mean) * (target - prev_center) / (center - prev_center)
+            prev_mean, prev_center = mean, center
+            cumulative += weight
+        if total == prev_center:
+            return self.max
+        return prev_mean + (self.max - prev_mean) * (target - prev_center) / (total - prev_center)
+
+    def to_bytes(self):
+        self.compress()
+        values = [self.min or 0, self.max or 0]
+        for mean, weight in self.centroids:
+            values.extend((mean, weight))
+        return struct.pack('<{}d'.format(len(values)), *values)
+
+    @classmethod
+    def from_bytes(cls, data, compression=100):
+        digest = cls(compression)
+        values = struct.unpack('<{}d'.format(len(data) // 8), data)
+        digest.centroids = [list(values[i:i + 2]) for i in range(2, len(values), 2)]
+        if digest.centroids:
+            digest.min, digest.max = values[0], values[1]
+        return digest
+
+
+class StatsSummary:
+    """
+    Count, sum, min, max, last value and a t-digest of a set of readings
+    """
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.last_time = None
+        self.last_value = None
+        self.digest = TDigest()
+
+    def add(self, timestamp, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if self.last_time is None or timestamp >= self.last_time:
+            self.last_time, self.last_value = timestamp, value
+        self.digest.add(value)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        if self.last_time is None or other.last_time >= self.last_time:
+            self.last_time, self.last_value = other.last_time, other.last_value
+        self.digest.merge(other.digest)
+
+    def to_dict(self, percentiles):
+        if not self.count:
+            return {'count': 0, 'sum': 0, 'mean': None, 'min': None, 'max': None,
+                    'last': None, 'percentiles': {}}
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count,
+                'min': self.min,
+                'max': self.max,
+                'last': {'timestamp': datetime_to_str(self.last_time),
+                         'value': self.last_value,
+                         },
+                'percentiles': {'p{:g}'.format(p): self.digest.quantile(p / 100) for p in percentiles},
+                }
+
+
+class SensorStatsAccumulator:
+    """
+    Collect stats for readings as they are added, flush_sensor_stats merges
+    them into the SensorStatsBucket rows in the background
+    """
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, sensor_id, timestamp, value):
+        start = chunk_start(timestamp, int(config['stats_bucket_interval']))
+        with self.lock:
+            summary = self.pending.get((sensor_id, start))
+            if summary is None:
+                summary = self.pending[(sensor_id, start)] = StatsSummary()
+            summary.add(timestamp, value)
+
+    def take(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+
+stats_accumulator = SensorStatsAccumulator()
+
+
+def record_reading_stats(sensor_id, data_type, date_added, value):
+    if not config['sensor_stats'] or data_type not in ('int', 'float'):
+        return
+    value = convert_value(data_type)(str(value))
+    if value is not None:
+        stats_accumulator.add(sensor_id, date_added or datetime.datetime.now(), value)
+
+
+# Sensors known to have a SensorStatsSince row
+stats_since_known = set()
+
+
+def mark_stats_since(pending):
+    """
+    The first time stats are flushed for a sensor, record that its buckets are
+    only complete from the next bucket on. The current one, and any older one
+    a reading with a client timestamp went into, can be missing readings
+    stored before stats were kept
+    """
+    interval = int(config['stats_bucket_interval'])
+    since = chunk_start(datetime.datetime.now(), interval) + datetime.timedelta(seconds=interval)
+    for sensor_id in {sensor_id for sensor_id, _ in pending} - stats_since_known:
+        try:
+            if SensorStatsSince.query.filter_by(sensor_id=sensor_id).scalar() is None:
+                stats_since = SensorStatsSince(since)
+                stats_since.sensor_id = sensor_id
+                db.session.add(stats_since)
+                db.session.commit()
+            stats_since_known.add(sensor_id)
+        except sqlalchemy.exc.IntegrityError:
+            # Another worker added it first
+            db.session.rollback()
+            stats_since_known.add(sensor_id)
+        except Exception:
+            logger.exception("[mark_stats_since] Failed to mark stats for sensor %s", sensor_id)
+            db.session.rollback()
+
+
+def get_stats_since(sensor_id):
+    return db.session.query(SensorStatsSince.since).filter_by(sensor_id=sensor_id).scalar()
+
+
+def flush_stats_bucket(sensor_id, start, summary):
+    # Lock the row so workers flushing the same bucket do not lose updates
+    bucket = SensorStatsBucket.query.filter_by(sensor_id=sensor_id, start=start)\
+                                    .with_for_update().scalar()
+    if bucket is None:
+        bucket = SensorStatsBucket(start)
+        bucket.sensor_id = sensor_id
+        db.session.add(bucket)
+    else:
+        summary.merge(bucket.summary())
+    bucket.update(summary)
+    db.session.commit()
+
+
+def flush_sensor_stats():
+    pending = stats_accumulator.take()
+    mark_stats_since(pending)
+    for (sensor_id, start), summary in pending.items():
+        try:
+            try:
+                flush_stats_bucket(sensor_id, start, summary)
+            except sqlalchemy.exc.IntegrityError:
+                # Another worker added the bucket first, the retry locks and merges into it
+                db.session.rollback()
+                flush_stats_bucket(sensor_id, start, summary)
+        except Exception:
+            logger.exception("[flush_sensor_stats] Failed to flush stats for sensor %s", sensor_id)
+            db.session.rollback()
+
+
+def run_stats_flush():
+    while True:
+        time.sleep(float(config['stats_flush_interval']))
+        with app.app_context():
+            flush_sensor_stats()
+
+
+def rebuild_sensor_stats(sensor):
+    """
+    Recreate the sensors stats buckets from before its stats since time, from
+    its readings, so every bucket is complete
+    """
+    interval = int(config['stats_bucket_interval'])
+    # Flush first so readings waiting in this process are not counted twice
+    flush_sensor_stats()
+    stats_since = SensorStatsSince.query.filter_by(sensor_id=sensor.id).scalar()
+    if stats_since is None:
+        # No stats kept yet, so the current bucket is built here and then added to as readings come in
+        stats_since = SensorStatsSince(chunk_start(datetime.datetime.now(), interval) +
+                                       datetime.timedelta(seconds=interval))
+        stats_since.sensor_id = sensor.id
+        db.session.add(stats_since)
+    cutoff = stats_since.since
+
+    SensorStatsBucket.query.filter_by(sensor_id=sensor.id)\
+                           .filter(SensorStatsBucket.start < cutoff).delete(synchronize_session=False)
+    buckets = {}
+    for timestamp, value in iter_sensor_points(sensor, end=cutoff - datetime.timedelta(microseconds=1)):
+        start = chunk_start(timestamp, interval)
+        if start not in buckets:
+            buckets[start] = StatsSummary()
+        buckets[start].add(timestamp, value)
+    for start, summary in buckets.items():
+        bucket = SensorStatsBucket(start)
+        bucket.sensor_id = sensor.id
+        bucket.update(summary)
+        db.session.add(bucket)
+    stats_since.since = EPOCH
+    db.session.commit()
+    stats_since_known.add(sensor.id)
+    return sum(summary.count for summary in buckets.values())
+
+
+def rebuild_stats_cli(sensor_key=None):
+    """
+    Backfill the stats buckets of one sensor, or of every int and float sensor
+    """
+    if not config['sensor_stats']:
+        print("sensor_stats is not enabled in the config")
+        return 1
+    sensors = Sensor.query.filter(Sensor.data_type.in_(['int', 'float']))\
+                          .filter(Sensor.user_id.isnot(None))
+    if sensor_key is not None:
+        sensors = sensors.filter_by(key=sensor_key)
+    sensors = sensors.all()
+    if not sensors:
+        print("No int or float sensor found")
+        return 1
+
+    for sensor in sensors:
+        count = rebuild_sensor_stats(sensor)
+        print("{},{}".format(sensor.key, count))
+    logger.info("Rebuilt stats for %s sensors", len(sensors))
+    return 0
+
+
+def get_sensor_stats(sensor, start=None, end=None):
+    """
+    Whole buckets inside the range are merged. The partial buckets at the
+    edges, anything before the sensors stats since time, and buckets that
+    closed too recently to have been flushed are summarized from the readings
+    """
+    summary = StatsSummary()
+    if sensor.data_type not in ('int', 'float'):
+        return summary
+    now = datetime.datetime.now()
+    if end is None:
+        end = now
+
+    interval = int(config['stats_bucket_interval'])
+    # Readings can wait up to a flush in a worker, and the flush itself takes time
+    flushed_until = chunk_start(now - datetime.timedelta(seconds=2 * float(config['stats_flush_interval'])),
+                                interval)
+    last_full_end = min(chunk_start(end, interval), flushed_until)
+    first_full = get_stats_since(sensor.id) if config['sensor_stats'] else None
+    if first_full is not None and start is not None:
+        start_full = chunk_start(start, interval)
+        if start_full < start:
+            start_full += datetime.timedelta(seconds=interval)
+        first_full = max(first_full, start_full)
+
+    if first_full is None or first_full >= last_full_end:
+        for timestamp, value in iter_sensor_points(sensor, start, end):
+            summary.add(timestamp, value)
+        return summary
+
+    for timestamp, value in iter_sensor_points(sensor, start, first_full - datetime.timedelta(microseconds=1)):
+        summary.add(timestamp, value)
+    buckets = SensorStatsBucket.query.filter_by(sensor_id=sensor.id)\
+                                     .filter(SensorStatsBucket.start >= first_full)\
+                                     .filter(SensorStatsBucket.start < last_full_end)
+    for bucket in buckets:
+        summary.merge(bucket.summary())
+    for timestamp, value in iter_sensor_points(sensor, last_full_end, end):
+        summary.add(timestamp, value)
+    return summary
+
+
+#######################
+# Rules
+#######################
+OPERATORS = {'>': operator.gt,
+             '>=': operator.ge,
+             '<': operator.lt,
+             '<=': operator.le,
+             '==': operator.eq,
+             '!=': operator.ne,
+             }
+
+DERIVED_FUNCTIONS = ('delta', 'rate')
+
+
+class RuleState:
+    """
+    What a rule needs to remember about a sensor between readings
+    """
+    __slots__ = ('last_time', 'last_value', 'breach_since', 'alerting')
+
+    def __init__(self):
+        self.last_time = None
+        self.last_value = None
+        self.breach_since = None
+        self.alerting = False
+
+
+class RuleEngine:
+    """
+    Evaluate the rules for each reading as it is added. Events and derived
+    readings are queued and written in batches by a background thread
+
+    Rule state is kept per process, so every reading for a sensor should be
+    added through the same process for duration and derived rules to be exact
+    """
+    def __init__(self, cache_ttl=30):
+        self.cache_ttl = cache_ttl
+        # (sensor_id, group_id) -> (rules, expires)
+        self._rules = {}
+        # sensor_id -> {rule_id: RuleState}
+        self.state = {}
+        self.lock = threading.Lock()
+        self.outputs = queue.Queue(maxsize=10000)
+
+    def clear_cache(self):
+        self._rules = {}
+
+    def rules_for(self, sensor_id, group_id):
+        now = time.time()
+        cached = self._rules.get((sensor_id, group_id))
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        rule_filter = SensorRule.sensor_id == sensor_id
+        if group_id is not None:
+            rule_filter = db.or_(rule_filter, SensorRule.group_id == group_id)
+        rules = SensorRule.query.filter(rule_filter).all()
+        for rule in rules:
+            db.session.expunge(rule)
+        self._rules[(sensor_id, group_id)] = (rules, now + self.cache_ttl)
+
+        # Drop the state of rules that were deleted, possibly by another process
+        rule_ids = {rule.id for rule in rules}
+        with self.lock:
+            sensor_state = self.state.get(sensor_id, {})
+            for rule_id in [rule_id for rule_id in sensor_state if rule_id not in rule_ids]:
+                del sensor_state[rule_id]
+        return rules
+
+    def forget_rule(self, rule_id):
+        self.clear_cache()
+        with self.lock:
+            for sensor_state in self.state.values():
+                sensor_state.pop(rule_id, None)
+
+    def evaluate(self, sensor_id, group_id, data_type, timestamp, value):
+        rules = self.rules_for(sensor_id, group_id)
+        if not rules or data_type not in ('int', 'float'):
+            return
+        value = convert_value(data_type)(str(value))
+        if value is None:
+            return
+
+        with self.lock:
+            sensor_state = self.state.setdefault(sensor_id, {})
+            for rule in rules:
+                state = sensor_state.get(rule.id)
+                if state is None:
+                    state = sensor_state[rule.id] = RuleState()
+                if state.last_time is not None and timestamp < state.last_time:
+                    # Out of order readings would break the windows
+                    continue
+
+                if rule.kind == 'threshold':
+                    self.evaluate_threshold(rule, state, sensor_id, timestamp, value)
+                elif rule.kind == 'derived' and state.last_time is not None:
+                    self.evaluate_derived(rule, state, timestamp, value)
+                state.last_time, state.last_value = timestamp, value
+
+    def evaluate_threshold(self, rule, state, sensor_id, timestamp, value):
+        if OPERATORS[rule.operator](value, rule.threshold):
+            if state.breach_since is None:
+                state.breach_since = timestamp
+            if not state.alerting and \
+               (timestamp - state.breach_since).total_seconds() >= (rule.duration or 0):
+                state.alerting = True
+                self.output('event', rule.id, sensor_id, 'alert', timestamp, value)
+        else:
+            if state.alerting:
+                self.output('event', rule.id, sensor_id, 'clear', timestamp, value)
+            state.breach_since = None
+            state.alerting = False
+
+    def evaluate_derived(self, rule, state, timestamp, value):
+        delta = value - state.last_value
+        if rule.function == 'rate':
+            seconds = (timestamp - state.last_time).total_seconds()
+            if seconds <= 0:
+                return
+            delta = delta / seconds
+        self.output('data', rule.id, rule.target_sensor_id, None, timestamp, delta)
+
+    def output(self, kind, rule_id, sensor_id, event, timestamp, value):
+        try:
+            self.outputs.put_nowait((kind, rule_id, sensor_id, event, timestamp, value))
+        except queue.Full:
+            logger.warning("[RuleEngine] Output queue is full, dropped %s for rule %s", kind, rule_id)
+
+    def write(self, outputs):
+        data_rows = []
+        event_rows = []
+        for kind, rule_id, sensor_id, event, timestamp, value in outputs:
+            if kind == 'data':
+                data_rows.append({'sensor_id': sensor_id, 'value': str(value), 'date_added': timestamp})
+            else:
+                event_rows.append({'rule_id': rule_id, 'sensor_id': sensor_id, 'kind': event,
+                                   'value': value, 'date_added': timestamp})
+
+        with app.app_context():
+            try:
+                if data_rows:
+                    db.session.execute(SensorData.__table__.insert(), data_rows)
+                if event_rows:
+                    db.session.execute(SensorEvent.__table__.insert(), event_rows)
+                db.session.commit()
+            except Exception:
+                logger.exception("[RuleEngine] Failed to write %s outputs", len(outputs))
+                db.session.rollback()
+                return
+
+        # Derived readings are counted in the stats, but do not trigger more rules
+        for row in data_rows:
+            record_reading_stats(row['sensor_id'], 'float', row['date_added'], row['value'])
+
+    def run(self):
+        while True:
+            outputs = [self.outputs.get()]
+            while len(outputs) < 1000:
+                try:
+                    outputs.append(self.outputs.get_nowait())
+                except queue.Empty:
+                    break
+            self.write(outputs)
+
+
+rule_engine = RuleEngine()
+
+
+def reading_added(sensor_id, group_id, data_type, date_added, value):
+    """
+    Update everything that is kept incrementally as readings are added
+    """
+    date_added = date_added or datetime.datetime.now()
+    record_reading_stats(sensor_id, data_type, date_added, value)
+    try:
+        rule_engine.evaluate(sensor_id, group_id, data_type, date_added, value)
+    except Exception:
+        logger.exception("[reading_added] Failed to evaluate rules for sensor %s", sensor_id)
+
+
+#######################
+# Line Protocol Ingest
+#######################
+class LineProtocolError(Exception):
+    pass
+
+
+TIMESTAMP_PRECISION = {'s': 1, 'ms': 10**3, 'us': 10**6, 'ns': 10**9}
+
+
+def parse_line(line, precision='ns'):
+    """
+    Parse a line in the format `<sensor_key>[,apikey=<apikey>] value=<value> [timestamp]`
+    :returns: sensor_key, apikey (None if not in the line), value, timestamp (None if not in the line)
+    """
+    try:
+        series, fields = line.split(' ', 1)
+    except ValueError:
+        raise LineProtocolError("Missing value")
+
+    tags = series.split(',')
+    sensor_key = tags[0]
+    apikey = None
+    for tag in tags[1:]:
+        tag_name, _, tag_value = tag.partition('=')
+        if tag_name == 'apikey':
+            apikey = tag_value
+
+    if not fields.startswith('value='):
+        raise LineProtocolError("Missing value")
+    fields = fields[6:]
+
+    if fields.startswith('"'):
+        # Quoted string values may contain spaces
+        end = fields.find('"', 1)
+        if end == -1:
+            raise LineProtocolError("Unterminated string value")
+        value = fields[1:end]
+        fields = fields[end + 1:]
+    else:
+        value, _, fields = fields.partition(' ')
+        if value.endswith('i') and value[:-1].lstrip('-').isdigit():
+            # Integer field, e.g. `value=42i`
+            value = value[:-1]
+
+    timestamp = None
+    fields = fields.strip()
+    if fields:
+        try:
+            timestamp = datetime.datetime.utcfromtimestamp(int(fields) / TIMESTAMP_PRECISION[precision])
+        except (ValueError, OverflowError, OSError):
+            raise LineProtocolError("Invalid timestamp: {}".format(fields))
+
+    return sensor_key, apikey, value, timestamp
+
+
+class LineProtocolIngest:
+    """
+    Validate readings from the line protocol listeners and write them to the
+    database in batches from a background thread
+    """
+    def __init__(self, batch_size, flush_interval, cache_ttl, precision, cache_size):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self.precision = precision
+        # Bounded so slow database writes push back on the clients
+        self.rows = queue.Queue(maxsize=batch_size * 10)
+        # apikey -> (user_id, expires) and
+        # sensor_key -> ((sensor_id, user_id, data_type, group_id), expires)
+        # Bounded as the port is open to anyone, who could send any number of unknown keys
+        self._apikeys = RecentlySeen(cache_size)
+        self._sensors = RecentlySeen(cache_size)
+
+    def _cached(self, cache, key, lookup):
+        now = time.time()
+        cached = cache.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        with app.app_context():
+            value = lookup(key)
+        cache.add(key, (value, now + self.cache_ttl))
+        return value
+
+    @staticmethod
+    def _lookup_apikey(apikey):
+        found_key = ApiKey.query.filter_by(key=apikey).scalar()
+        if found_key is None:
+            return None
+        return found_key.user_id
+
+    @staticmethod
+    def _lookup_sensor(sensor_key):
+        sensor = Sensor.query.filter_by(key=sensor_key).scalar()
+        if sensor is None:
+            return None
+        return sensor.id, sensor.user_id, sensor.data_type, sensor.group_id
+
+    def add_line(self, line, apikey=None):
+        sensor_key, line_apikey, value, timestamp = parse_line(line, self.precision)
+        apikey = line_apikey or apikey
+        if apikey is None:
+            raise LineProtocolError("Missing api key")
+
+        key_user_id = self._cached(self._apikeys, apikey, self._lookup_apikey)
+        if key_user_id is None:
+            raise LineProtocolError("Invalid api key")
+
+        sensor = self._cached(self._sensors, sensor_key, self._lookup_sensor)
+        # The api key and sensor must both belong to the same user
+        if sensor is None or sensor[1] != key_user_id:
+            raise LineProtocolError("Invalid sensor key: {}".format(sensor_key))
+
+        if rate_limit_wait('apikey', apikey) or rate_limit_wait('sensor', sensor_key):
+            raise LineProtocolError("Rate limit exceeded")
+
+        if timestamp is not None:
+            timestamp = stored_timestamp(timestamp)
+            if seen_readings.get((sensor[0], timestamp)) is not None:
+                # Already added, resent by a client replaying its buffer
+                return
+
+        self.rows.put(({'sensor_id': sensor[0],
+                        'value': value,
+                        'date_added': timestamp or datetime.datetime.now(),
+                        }, sensor, timestamp is not None))
+
+    @staticmethod
+    def drop_duplicates(rows):
+        """
+        Remove readings with a client timestamp that are already stored, or
+        are in the batch more then once. Checks sensor_data with one query
+        per sensor in the batch
+        """
+        timestamps = collections.defaultdict(set)
+        for row, _, timestamped in rows:
+            if timestamped:
+                timestamps[row['sensor_id']].add(row['date_added'])
+
+        stored = set()
+        for sensor_id, sensor_timestamps in timestamps.items():
+            for timestamps_chunk in chunked(list(sensor_timestamps)):
+                found = db.session.query(SensorData.date_added)\
+                                  .filter(SensorData.sensor_id == sensor_id)\
+                                  .filter(SensorData.date_added.in_(timestamps_chunk))
+                stored.update((sensor_id, date_added) for date_added, in found)
+
+        unique_rows = []
+        for row, sensor, timestamped in rows:
+            reading = (row['sensor_id'], row['date_added'])
+            if timestamped:
+                if reading in stored or in_compacted_storage(*reading):
+                    continue
+                stored.add(reading)
+            unique_rows.append((row, sensor, timestamped))
+        return unique_rows
+
+    def write(self, rows):
+        """
+        :param rows: list of (sensor_data row, cached sensor, has a client timestamp)
+        """
+        with app.app_context():
+            try:
+                rows = self.drop_duplicates(rows)
+                if not rows:
+                    return
+                db.session.execute(SensorData.__table__.insert(), [row for row, _, _ in rows])
+                db.session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                # A sensor was deleted after it was cached, write the rest one at a time
+                db.session.rollback()
+                if len(rows) == 1:
+                    logger.warning("[LineProtocolIngest] Dropped row for sensor %s", rows[0][0]['sensor_id'])
+                else:
+                    for row in rows:
+                        self.write([row])
+                return
+            except Exception:
+                logger.exception("[LineProtocolIngest] Failed to write %s rows", len(rows))
+                db.session.rollback()
+                return
+
+            for row, (sensor_id, _, data_type, group_id), timestamped in rows:
+                if timestamped:
+                    seen_readings.add((sensor_id, row['date_added']))
+                reading_added(sensor_id, group_id, data_type, row['date_added'], row['value'])
+
+    def run(self):
+        while True:
+            rows = [self.rows.get()]
+            flush_at = time.time() + self.flush_interval
+            while len(rows) < self.batch_size:
+                timeout = flush_at - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(self.rows.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.write(rows)
+
+
+class LineProtocolTCPHandler(socketserver.StreamRequestHandler):
+    """
+    A connection can send `AUTH <apikey>` once instead of tagging every line
+    Errors are sent back as `ERR <message>` lines
+    """
+    def handle(self):
+        apikey = None
+        for raw_line in self.rfile:
+            line = raw_line.decode('utf-8', 'replace').strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('AUTH '):
+                apikey = line[5:].strip()
+                continue
+            try:
+                self.server.ingest.add_line(line, apikey)
+            except LineProtocolError as e:
+                logger.debug("[LineProtocolTCPHandler] %s: %s", e, line)
+                self.wfile.write("ERR {}\n".format(e).encode('utf-8'))
+
+
+class LineProtocolUDPHandler(socketserver.DatagramRequestHandler):
+    """
+    A datagram may start with an `AUTH <apikey>` line that covers the rest of its lines
+    """
+    def handle(self):
+        apikey = None
+        for raw_line in self.rfile:
+            line = raw_line.decode('utf-8', 'replace').strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('AUTH '):
+                apikey = line[5:].strip()
+                continue
+            try:
+                self.server.ingest.add_line(line, apikey)
+            except LineProtocolError as e:
+                logger.debug("[LineProtocolUDPHandler] %s: %s", e, line)
+
+
+class LineProtocolTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def start_line_protocol_listeners():
+    ingest = LineProtocolIngest(int(config['line_protocol_batch_size']),
+                                float(config['line_protocol_flush_interval']),
+                                float(config['line_protocol_cache_ttl']),
+                                config['line_protocol_precision'],
+                                int(config['line_protocol_cache_size']))
+    address = (config['host'], int(config['line_protocol_port']))
+
+    tcp_server = LineProtocolTCPServer(address, LineProtocolTCPHandler)
+    udp_server = socketserver.UDPServer(address, LineProtocolUDPHandler)
+    for server in (tcp_server, udp_server):
+        server.ingest = ingest
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=ingest.run, daemon=True).start()
+
+    logger.info("Line protocol listening on %s:%s (tcp/udp)", *address)
+    return ingest
+
+
 #######################
 # App Utils
 #######################
@@ -938,6 +3849,40 @@ def datetime_to_str(timestamp):
     return timestamp.isoformat() + "+0000"
 
 
+def parse_timestamp(timestamp):
+    """
+    Parse an ISO timestamp (as returned by datetime_to_str) or epoch seconds
+    :returns: naive datetime in UTC
+    :raises ValueError: for anything that is not a valid timestamp, including out of range ones
+    """
+    try:
+        if isinstance(timestamp, (int, float)):
+            return datetime.datetime.utcfromtimestamp(timestamp)
+
+        try:
+            return datetime.datetime.utcfromtimestamp(float(timestamp))
+        except ValueError:
+            pass
+
+        timestamp = timestamp.replace('Z', '+0000')
+        try:
+            timestamp = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f%z")
+        except ValueError:
+            timestamp = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S%z")
+        # Stored times are naive UTC
+        return (timestamp - timestamp.utcoffset()).replace(tzinfo=None)
+    except (OverflowError, OSError):
+        raise ValueError("Timestamp out of range: {}".format(timestamp))
+
+
+def datetime_to_epoch_ms(timestamp):
+    return calendar.timegm(timestamp.timetuple()) * 1000 + timestamp.microsecond // 1000
+
+
+def epoch_ms_to_datetime(epoch_ms):
+    return datetime.datetime.utcfromtimestamp(epoch_ms / 1000)
+
+
 def convert_value(data_type):
     def default(value):
         # Just return as a string
@@ -983,27 +3928,131 @@ def convert_value(data_type):
     return default
 
 
-def get_value_list(values, data_type):
+def get_value_list(points, data_type):
     """
+    :param points: (timestamp, converted value, raw value) tuples
     :returns: list of valid data points, list of failed data points
     """
     data_list = []
     data_errors = []
-    convert = convert_value(data_type)
-    for data in values:
-        converted_value = convert(data.value)
+    for timestamp, converted_value, value in points:
         if converted_value is not None:
-            data_list.append({'timestamp': datetime_to_str(data.date_added),
+            data_list.append({'timestamp': datetime_to_str(timestamp),
                               'value': converted_value
                               })
         else:
-            data_errors.append({'timestamp': datetime_to_str(data.date_added),
-                                'value': data.value,
+            data_errors.append({'timestamp': datetime_to_str(timestamp),
+                                'value': value,
                                 'error_msg': "Could not convert data point to " + data_type
                                 })
     return data_list, data_errors
 
 
+def get_value_columns(points, data_type):
+    """
+    :param points: (timestamp, converted value, raw value) tuples
+    :returns: list of epoch ms timestamps, list of valid values, list of failed data points
+    """
+    timestamps = []
+    data_list = []
+    data_errors = []
+    for timestamp, converted_value, value in points:
+        if converted_value is not None:
+            timestamps.append(datetime_to_epoch_ms(timestamp))
+            data_list.append(converted_value)
+        else:
+            data_errors.append({'timestamp': datetime_to_str(timestamp),
+                                'value': value,
+                                'error_msg': "Could not convert data point to " + data_type
+                                })
+    return timestamps, data_list, data_errors
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, types):
+    """
+    :param types: the type of each value the cursor must hold
+    :returns: list of the cursors values
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(types) or \
+       not all(type(value) is value_type for value, value_type in zip(values, types)):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def datatable_response(query, columns, search_columns, row_to_dict, id_column):
+    """
+    Page, sort and search `query` using the DataTables server-side processing params
+    :param columns: column name -> column to sort by
+    :param search_columns: column names that are prefix matched by the search box
+    :param row_to_dict: converts a result row into the dict sent to the table
+    :param id_column: unique column sorted by last, so pages are stable when sort values repeat
+    """
+    try:
+        draw = int(request.args.get('draw', 0))
+        start = max(int(request.args.get('start', 0)), 0)
+        length = int(request.args.get('length', 10))
+    except ValueError:
+        abort(400)
+    # -1 (show all rows) gets the largest page too
+    if length < 1 or length > config['datatable_max_length']:
+        length = config['datatable_max_length']
+
+    records_total = query.order_by(None).count()
+
+    search = request.args.get('search[value]', '').strip()
+    if search:
+        pattern = escape_like(search) + '%'
+        query = query.filter(db.or_(*[columns[name].like(pattern, escape='\\')
+                                      for name in search_columns]))
+        records_filtered = query.order_by(None).count()
+    else:
+        records_filtered = records_total
+
+    i = 0
+    while 'order[{}][column]'.format(i) in request.args:
+        column_index = request.args['order[{}][column]'.format(i)]
+        column = columns.get(request.args.get('columns[{}][data]'.format(column_index)))
+        if column is not None:
+            if request.args.get('order[{}][dir]'.format(i)) == 'desc':
+                query = query.order_by(column.desc())
+            else:
+                query = query.order_by(column.asc())
+        i += 1
+
+    query = query.order_by(id_column.asc()).offset(start).limit(length)
+
+    return jsonify(draw=draw,
+                   recordsTotal=records_total,
+                   recordsFiltered=records_filtered,
+                   data=[row_to_dict(row) for row in query])
+
+
+def create_missing_indexes():
+    """
+    db.create_all() only creates tables that do not exist yet, so add any
+    index declared on a model that an existing table is missing
+    """
+    inspector = sqlalchemy.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name, schema=table.schema)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info("Creating index %s on %s", index.name, table.name)
+                index.create(db.engine)
+
+
 @login_manager.user_loader
 def load_user(id):
     return User.query.get(int(id))
@@ -1014,8 +4063,87 @@ def before_request():
     g.user = current_user
 
 
+def compress_stream(chunks, encoding):
+    """
+    gzip/deflate a streamed response as it is sent, compress_response can not
+    as it needs the whole body
+    """
+    # wbits picks the gzip or zlib container, the same ones gzip.compress and zlib.compress use
+    compressor = zlib.compressobj(config['compress_level'], zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.after_request
+def compress_response(response):
+    """
+    gzip/deflate the response if the client accepts it
+    """
+    if response.direct_passthrough or response.is_streamed or response.status_code != 200 or \
+       'Content-Encoding' in response.headers:
+        return response
+
+    encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+    if encoding is None:
+        return response
+
+    body = response.get_data()
+    if len(body) < config['compress_min_size']:
+        return response
+
+    if encoding == 'gzip':
+        body = gzip.compress(body, config['compress_level'])
+    else:
+        body = zlib.compress(body, config['compress_level'])
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Content-Length'] = len(body)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 if __name__ == '__main__':
     db.create_all()
+    create_missing_indexes()
+    if sys.argv[2:3] == ['provision-groups']:
+        if len(sys.argv) != 6:
+            print("Usage:", sys.argv[0], "<configfile> provision-groups <email> <template_name> <names_file>")
+            sys.exit(1)
+        with app.app_context():
+            sys.exit(provision_groups_cli(*sys.argv[3:6]))
+    if sys.argv[2:3] == ['rebuild-stats']:
+        if len(sys.argv) > 4:
+            print("Usage:", sys.argv[0], "<configfile> rebuild-stats [<sensor_key>]")
+            sys.exit(1)
+        with app.app_context():
+            sys.exit(rebuild_stats_cli(*sys.argv[3:4]))
+
+    # With the reloader on only start the background threads in the child process
+    if not config['debug'] or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        threading.Thread(target=run_deletion_jobs, daemon=True).start()
+        threading.Thread(target=rule_engine.run, daemon=True).start()
+        if replica_pool.engines:
+            threading.Thread(target=replica_pool.run, args=(float(config['replica_check_interval']),),
+                             daemon=True).start()
+        if config['line_protocol_port']:
+            start_line_protocol_listeners()
+        if config['chunk_storage']:
+            threading.Thread(target=run_chunk_compaction, daemon=True).start()
+        if config['archive_dir']:
+            threading.Thread(target=run_archive, daemon=True).start()
+        if config['sensor_stats']:
+            threading.Thread(target=run_stats_flush, daemon=True).start()
+
+            @atexit.register
+            def flush_sensor_stats_on_exit():
+                with app.app_context():
+                    flush_sensor_stats()
+
     app.run(threaded=True,
             debug=config['debug'],
             host=config['host'],
@@ -1,6 +1,57 @@
 $(function(){
-    $('.table-list').dataTable();
-    $('.sensor-list').dataTable({
-        "aaSorting": [ [0, 'asc'], [1, 'asc'] ]
-    });
+    function text(data){
+        return $('<div/>').text(data == null ? '' : data).html();
+    }
+
+    function deleteLink(url){
+        return function(id){
+            return '<a href="' + url + id + '">Delete</a>';
+        };
+    }
+
+    // Tables are paged, sorted and searched by the server
+    function serverTable(selector, url, columns, order){
+        $(selector).dataTable({
+            "serverSide": true,
+            "processing": true,
+            "searchDelay": 400,
+            "ajax": url,
+            "columns": columns,
+            "order": order || [ [0, 'asc'] ]
+        });
+    }
+
+    serverTable('#apikey-list', '/apikeys/data', [
+        {"data": "name", "render": text},
+        {"data": "key", "render": text},
+        {"data": "date_added"},
+        {"data": "id", "render": deleteLink('/apikey/delete/'), "orderable": false}
+    ]);
+
+    serverTable('#sensor-list', '/sensors/data', [
+        {"data": "group", "render": text},
+        {"data": "name", "render": text},
+        {"data": "key", "render": text},
+        {"data": "data_type", "render": text},
+        {"data": "date_added"},
+        {"data": "id", "render": deleteLink('/sensor/delete/'), "orderable": false}
+    ], [ [0, 'asc'], [1, 'asc'] ]);
+
+    serverTable('#group-list', '/groups/data', [
+        {"data": "name", "render": text},
+        {"data": "key", "render": text},
+        {"data": "id", "render": deleteLink('/group/delete/'), "orderable": false}
+    ]);
+
+    serverTable('#group-template-list', '/templates/groups/data', [
+        {"data": "name", "render": text},
+        {"data": "id", "render": deleteLink('/template/delete/group/'), "orderable": false}
+    ]);
+
+    serverTable('#sensor-template-list', '/templates/sensors/data', [
+        {"data": "group", "render": text},
+        {"data": "name", "render": text},
+        {"data": "data_type", "render": text},
+        {"data": "id", "render": deleteLink('/template/delete/sensor/'), "orderable": false}
+    ], [ [0, 'asc'], [1, 'asc'] ]);
 });
@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py loads its config from argv[1] when it is imported, give it a test
+# config instead of whatever arguments pytest was started with
+config_dir = tempfile.mkdtemp()
+config_file = os.path.join(config_dir, 'config.yaml')
+with open(config_file, 'w') as stream:
+    stream.write("db_uri: 'sqlite://'\n")
+    stream.write("log_file: '{}'\n".format(os.path.join(config_dir, 'logs', 'datalogging.log')))
+sys.argv = [sys.argv[0], config_file]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as datalogging  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    datalogging.app.config['TESTING'] = True
+    return datalogging.app.test_client()
@@ -0,0 +1,33 @@
+import gzip
+import zlib
+
+
+def test_page_is_gzipped(client):
+    response = client.get('/login', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert b'<form' in gzip.decompress(response.data)
+
+
+def test_page_is_deflated(client):
+    response = client.get('/login', headers={'Accept-Encoding': 'deflate'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'deflate'
+    assert b'<form' in zlib.decompress(response.data)
+
+
+def test_page_without_accept_encoding(client):
+    response = client.get('/login')
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert b'<form' in response.data
+
+
+def test_static_file(client):
+    response = client.get('/static/js/init.js', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+
+
+def test_api_without_apikey(client):
+    response = client.get('/api/v1/get/sensor', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 401
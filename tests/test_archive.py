@@ -0,0 +1,91 @@
+import datetime
+
+import pytest
+
+import app as datalogging
+from app import ARCHIVE_INDEX_INTERVAL, ArchiveSegment, append_segment, archive_path, read_segment
+
+START = datetime.datetime(2016, 6, 1)
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(datalogging.config, 'archive_dir', str(tmp_path))
+    return tmp_path
+
+
+def new_segment(seq=0):
+    segment = ArchiveSegment(seq)
+    segment.sensor_id = 1
+    return segment
+
+
+def make_points(count, first=0):
+    # Three readings per second so timestamps repeat across index blocks
+    return [(START + datetime.timedelta(seconds=i // 3), 'value {}'.format(i))
+            for i in range(first, first + count)]
+
+
+def read(segment, *args, **kwargs):
+    return list(read_segment(archive_path(segment.sensor_id, segment.seq),
+                             segment.count, segment.size, *args, **kwargs))
+
+
+def test_round_trip(archive_dir):
+    points = make_points(ARCHIVE_INDEX_INTERVAL * 3 + 5)
+    segment = new_segment()
+    append_segment(segment, points[:100])
+    append_segment(segment, points[100:])
+
+    assert segment.count == len(points)
+    assert segment.start == points[0][0]
+    assert segment.end == points[-1][0]
+    assert read(segment) == points
+    assert read(segment, reverse=True) == points[::-1]
+
+
+def test_unicode_values(archive_dir):
+    points = [(START, ''), (START, 'ünïcødé ✓'), (START + datetime.timedelta(seconds=1), 'a b "c"')]
+    segment = new_segment()
+    append_segment(segment, points)
+    assert read(segment) == points
+
+
+@pytest.mark.parametrize('start, end', [
+    (0, 0),
+    (10, 20),
+    (42, 43),
+    (-5, 3),
+    (130, 1000),
+    (None, 50),
+    (50, None),
+    (200, 300),
+])
+def test_ranges(archive_dir, start, end):
+    points = make_points(ARCHIVE_INDEX_INTERVAL * 3 + 5)
+    segment = new_segment()
+    append_segment(segment, points)
+
+    start = START + datetime.timedelta(seconds=start) if start is not None else None
+    end = START + datetime.timedelta(seconds=end) if end is not None else None
+    expected = [point for point in points
+                if (start is None or point[0] >= start) and (end is None or point[0] <= end)]
+    assert read(segment, start, end) == expected
+    assert read(segment, start, end, reverse=True) == expected[::-1]
+
+
+def test_uncommitted_write_is_ignored_and_overwritten(archive_dir):
+    points = make_points(ARCHIVE_INDEX_INTERVAL + 10)
+    segment = new_segment()
+    append_segment(segment, points)
+
+    # A write whose commit failed leaves bytes past the committed size
+    failed = new_segment()
+    failed.count, failed.size, failed.start, failed.end = segment.count, segment.size, segment.start, segment.end
+    append_segment(failed, make_points(ARCHIVE_INDEX_INTERVAL * 2, first=10000))
+    assert read(segment) == points
+
+    more = make_points(20, first=len(points))
+    append_segment(segment, more)
+    assert read(segment) == points + more
+    assert read(segment, reverse=True) == (points + more)[::-1]
@@ -0,0 +1,75 @@
+import datetime
+import math
+
+import pytest
+
+from app import EPOCH, INT_CHUNK_LIMIT, CHUNK_ENCODINGS, encode_chunk, decode_chunk
+
+
+def timestamps(count):
+    # Irregular gaps so every delta-of-delta bucket is used
+    gaps = [1, 1, 2, 10**6, 3, 86400 * 10**6, 1, 2**40]
+    timestamp = EPOCH + datetime.timedelta(days=17000, microseconds=123)
+    result = []
+    for i in range(count):
+        result.append(timestamp)
+        timestamp += datetime.timedelta(microseconds=gaps[i % len(gaps)])
+    return result
+
+
+def round_trip(values, encoding):
+    points = list(zip(timestamps(len(values)), values))
+    assert all(CHUNK_ENCODINGS[encoding][2](value) for value in values)
+    return points, decode_chunk(encode_chunk(points, encoding), len(points), encoding)
+
+
+@pytest.mark.parametrize('values', [
+    [0.0],
+    [1.5, 1.5, 1.5],
+    [0.0, -0.0, 0.0, -0.0],
+    [float('inf'), float('-inf'), 1.0, float('inf')],
+    [21.5, 21.7, 21.6, 1e308, 5e-324, -1e-308, 21.5],
+    [math.pi * i for i in range(200)],
+])
+def test_float_round_trip(values):
+    points, decoded = round_trip(values, 'float')
+    assert [timestamp for timestamp, _ in decoded] == [timestamp for timestamp, _ in points]
+    # Compare the bits so -0.0 and 0.0 are told apart
+    assert [math.copysign(1, value) for _, value in decoded] == [math.copysign(1, value) for value in values]
+    assert [value for _, value in decoded] == values
+
+
+def test_float_nan_round_trip():
+    _, decoded = round_trip([1.0, float('nan'), 2.0], 'float')
+    assert decoded[0][1] == 1.0
+    assert math.isnan(decoded[1][1])
+    assert decoded[2][1] == 2.0
+
+
+@pytest.mark.parametrize('values', [
+    [0],
+    [7, 7, 7, 7],
+    [2**59, -2**59, 2**59, 0],
+    [INT_CHUNK_LIMIT - 1, -INT_CHUNK_LIMIT + 1],
+    [i * i * (-1) ** i for i in range(300)],
+])
+def test_int_round_trip(values):
+    points, decoded = round_trip(values, 'int')
+    assert decoded == points
+
+
+def test_int_limit():
+    assert not CHUNK_ENCODINGS['int'][2](INT_CHUNK_LIMIT)
+    assert not CHUNK_ENCODINGS['int'][2](-INT_CHUNK_LIMIT)
+
+
+@pytest.mark.parametrize('values', [
+    [True],
+    [False],
+    [True, True, False, False, False, True],
+    [i % 3 == 0 for i in range(100)],
+    [False] * 70000 + [True],
+])
+def test_boolean_round_trip(values):
+    points, decoded = round_trip(values, 'boolean')
+    assert decoded == points
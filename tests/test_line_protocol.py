@@ -0,0 +1,47 @@
+import datetime
+
+import pytest
+
+from app import LineProtocolError, parse_line
+
+
+def test_value_and_timestamp():
+    assert parse_line('aB3dE9 value=21.5 1466000000000000000') == \
+        ('aB3dE9', None, '21.5', datetime.datetime(2016, 6, 15, 14, 13, 20))
+
+
+def test_apikey_tag_and_no_timestamp():
+    assert parse_line('aB3dE9,apikey=abc value=21.5') == ('aB3dE9', 'abc', '21.5', None)
+
+
+def test_integer_field():
+    assert parse_line('aB3dE9 value=-42i')[2] == '-42'
+
+
+def test_quoted_string():
+    assert parse_line('aB3dE9 value="some text" 1466000000', 's') == \
+        ('aB3dE9', None, 'some text', datetime.datetime(2016, 6, 15, 14, 13, 20))
+
+
+@pytest.mark.parametrize('precision, timestamp', [
+    ('s', '1466000000'),
+    ('ms', '1466000000000'),
+    ('us', '1466000000000000'),
+    ('ns', '1466000000000000000'),
+])
+def test_precision(precision, timestamp):
+    assert parse_line('aB3dE9 value=1 ' + timestamp, precision)[3] == datetime.datetime(2016, 6, 15, 14, 13, 20)
+
+
+@pytest.mark.parametrize('line, message', [
+    ('aB3dE9', "Missing value"),
+    ('aB3dE9 temp=1', "Missing value"),
+    ('aB3dE9 value="no end', "Unterminated string value"),
+    ('aB3dE9 value=1 soon', "Invalid timestamp"),
+    ('aB3dE9 value=1 1.5', "Invalid timestamp"),
+    ('aB3dE9 value=1 ' + '9' * 40, "Invalid timestamp"),
+])
+def test_errors(line, message):
+    with pytest.raises(LineProtocolError) as error:
+        parse_line(line)
+    assert str(error.value).startswith(message)
@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from app import TDigest
+
+
+def uniform_digest(values):
+    digest = TDigest()
+    for value in values:
+        digest.add(value)
+    return digest
+
+
+@pytest.mark.parametrize('q', [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99])
+def test_quantile_bounds(q):
+    values = list(range(1, 100001))
+    random.Random(1).shuffle(values)
+    digest = uniform_digest(values)
+    # Within 1% of the range, and tighter towards the tails
+    assert abs(digest.quantile(q) - q * 100000) <= 1000 * min(1, 4 * q * (1 - q))
+
+
+def test_min_and_max():
+    digest = uniform_digest([5.0, -3.0, 12.5, 7.0])
+    assert digest.quantile(0) == -3.0
+    assert digest.quantile(1) == 12.5
+    assert -3.0 <= digest.quantile(0.5) <= 12.5
+
+
+def test_single_value():
+    digest = uniform_digest([42.0])
+    assert digest.quantile(0) == digest.quantile(0.5) == digest.quantile(1) == 42.0
+
+
+def test_merge_matches_single_digest():
+    values = [random.Random(2).gauss(0, 1) for _ in range(20000)]
+    merged = uniform_digest(values[:10000])
+    merged.merge(uniform_digest(values[10000:]))
+    values.sort()
+    for q in (0.05, 0.5, 0.95):
+        assert abs(merged.quantile(q) - values[int(q * len(values))]) < 0.05
+
+
+def test_bytes_round_trip():
+    digest = uniform_digest(range(1000))
+    loaded = TDigest.from_bytes(digest.to_bytes())
+    assert loaded.min == 0 and loaded.max == 999
+    for q in (0, 0.1, 0.5, 0.9, 1):
+        assert loaded.quantile(q) == pytest.approx(digest.quantile(q))
+
+
+def test_empty_bytes_round_trip():
+    loaded = TDigest.from_bytes(TDigest().to_bytes())
+    assert loaded.min is None and loaded.centroids == []